@@ -34,6 +34,39 @@ long endpos = -25000;
 long pos = 0;
 int message = 0;
 
+const char* FW_ID = "arenafw 2 frames";
+
+// Framed commands
+// ---------------
+// 9 bytes: FRAME_START, opcode, sequence number, LED bitmask,
+// value (int32, little endian) and the XOR of the 7 bytes before it.
+// Each frame gets one reply line "#<seq> ok" or "#<seq> bad".
+// The start byte is above ASCII, so the letter commands still work.
+const byte FRAME_START = 0xA5;
+const int FRAME_LEN = 9;
+
+const byte OP_PING = 0;
+const byte OP_MOVE = 1;      // value: signed motor steps
+const byte OP_ALIGN = 2;
+const byte OP_LEDS_ON = 3;   // mask: LEDs to switch on
+const byte OP_LEDS_OFF = 4;  // mask: LEDs to switch off
+const byte OP_PULSE = 5;     // mask: LEDs to switch on, value: ms to keep them on
+const byte OP_STATUS = 6;    // reply: "#<seq> ok <position> <target> <moving> <LED mask>"
+
+const int led_pins[] = {p_led1, p_led2, p_led3, p_led4, p_led5, p_led6};
+const int N_LEDS = 6;
+
+// millis() when each pulsed LED goes off, pulsing marks the LEDs with a pulse going.
+// Any later command setting an LED (frame or letter) ends its pulse.
+unsigned long pulse_end[6];
+byte pulsing = 0;
+
+byte frame[FRAME_LEN];
+int frame_len = 0;
+unsigned long frame_time = 0;
+// A frame not completed within this time (ms) is dropped
+const unsigned long FRAME_TIMEOUT = 100;
+
 void setup() {
 	
 	Serial.begin(9600);
@@ -49,12 +82,127 @@ void setup() {
 	motor.setAcceleration(1000.);
 	motor.setSpeed(500);
 }
+void set_leds(byte mask, int value) {
+	for (int i=0; i<N_LEDS; i++) {
+		if (mask & (1 << i)) {
+			digitalWrite(led_pins[i], value);
+		}
+	}
+}
+
+void end_pulses() {
+	unsigned long now = millis();
+	for (int i=0; i<N_LEDS; i++) {
+		if ((pulsing & (1 << i)) && (long)(now - pulse_end[i]) >= 0) {
+			digitalWrite(led_pins[i], 0);
+			pulsing &= ~(1 << i);
+		}
+	}
+}
+
+void run_frame() {
+	byte check = 0;
+	for (int i=0; i<FRAME_LEN-1; i++) {
+		check ^= frame[i];
+	}
+	byte op = frame[1];
+	byte seq = frame[2];
+	byte mask = frame[3];
+	long value = (long)frame[4] | ((long)frame[5] << 8) |
+		((long)frame[6] << 16) | ((long)frame[7] << 24);
+
+	Serial.print("#");
+	Serial.print(seq);
+
+	if (check != frame[FRAME_LEN-1]) {
+		Serial.println(" bad");
+		return;
+	}
+
+	if (op==OP_PING) {
+	}
+	else if (op==OP_MOVE) {
+		motor.setMaxSpeed(1300.);
+		motor.setAcceleration(1000.);
+		pos += value;
+		motor.moveTo(pos);
+	}
+	else if (op==OP_ALIGN) {
+		motor.setAcceleration(10000.);
+		motor.setMaxSpeed(2500.);
+		pos -= 250;
+		motor.moveTo(pos);
+	}
+	else if (op==OP_LEDS_ON) {
+		set_leds(mask, 1);
+		pulsing &= ~mask;
+	}
+	else if (op==OP_LEDS_OFF) {
+		set_leds(mask, 0);
+		pulsing &= ~mask;
+	}
+	else if (op==OP_STATUS) {
+		byte leds = 0;
+		for (int i=0; i<N_LEDS; i++) {
+			if (digitalRead(led_pins[i])) {
+				leds |= (1 << i);
+			}
+		}
+		Serial.print(" ok ");
+		Serial.print(motor.currentPosition());
+		Serial.print(" ");
+		Serial.print(motor.targetPosition());
+		Serial.print(" ");
+		Serial.print(motor.isRunning() ? 1 : 0);
+		Serial.print(" ");
+		Serial.println(leds);
+		return;
+	}
+	else if (op==OP_PULSE) {
+		set_leds(mask, 1);
+		unsigned long end = millis() + value;
+		for (int i=0; i<N_LEDS; i++) {
+			if (mask & (1 << i)) {
+				pulse_end[i] = end;
+			}
+		}
+		pulsing |= mask;
+	}
+	else {
+		Serial.println(" bad");
+		return;
+	}
+	Serial.println(" ok");
+}
+
 void loop() {
 
+	if (pulsing) {
+		end_pulses();
+	}
+
+	if (frame_len > 0 && millis() - frame_time > FRAME_TIMEOUT) {
+		frame_len = 0;
+	}
+
 	if (Serial.available() > 0) {
 		message = Serial.read();
 		
-		if (message==114) {
+		if (frame_len > 0) {
+			frame[frame_len++] = message;
+			if (frame_len == FRAME_LEN) {
+				run_frame();
+				frame_len = 0;
+			}
+		}
+		else if (message==FRAME_START) {
+			frame[frame_len++] = message;
+			frame_time = millis();
+		}
+		else if (message=='?') {
+			Serial.println(FW_ID);
+		}
+		else if (message==114) {
 			motor.setMaxSpeed(1300.);
 			motor.setAcceleration(1000.);
 			pos += 500;
@@ -77,51 +225,63 @@ void loop() {
 		}
 		else if (message=='A') {
 			digitalWrite(p_led1, 1);
+			pulsing &= ~(1 << 0);
 			Serial.println("LED1-on");
 		}
 		else if (message=='B') {
 			digitalWrite(p_led2, 1);
+			pulsing &= ~(1 << 1);
 			Serial.println("LED2-on");
 		}
 		else if (message=='C') {
 			digitalWrite(p_led3, 1);
+			pulsing &= ~(1 << 2);
 			Serial.println("LED3-on");
 		}
 		else if (message=='D') {
 			digitalWrite(p_led4, 1);
+			pulsing &= ~(1 << 3);
 			Serial.println("LED4-on");
 		}
 		else if (message=='E') {
 			digitalWrite(p_led5, 1);
+			pulsing &= ~(1 << 4);
 			Serial.println("LED5-on");
 		}
 		else if (message=='F') {
 			digitalWrite(p_led6, 1);
+			pulsing &= ~(1 << 5);
 			Serial.println("LED6-on");
 		}
 		
 		else if (message=='a') {
 			digitalWrite(p_led1, 0);
+			pulsing &= ~(1 << 0);
 			Serial.println("LED1-off");
 		}
 		else if (message=='b') {
 			digitalWrite(p_led2, 0);
+			pulsing &= ~(1 << 1);
 			Serial.println("LED2-off");
 		}
 		else if (message=='c') {
 			digitalWrite(p_led3, 0);
+			pulsing &= ~(1 << 2);
 			Serial.println("LED3-off");
 		}
 		else if (message=='d') {
 			digitalWrite(p_led4, 0);
+			pulsing &= ~(1 << 3);
 			Serial.println("LED4-off");
 		}
 		else if (message=='e') {
 			digitalWrite(p_led5, 0);
+			pulsing &= ~(1 << 4);
 			Serial.println("LED5-off");
 		}
 		else if (message=='f') {
 			digitalWrite(p_led6, 0);
+			pulsing &= ~(1 << 5);
 			Serial.println("LED6-off");
 		}
 	
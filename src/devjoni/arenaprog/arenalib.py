@@ -2,43 +2,344 @@
 '''
 
 import os
-import platform
+import time
+import struct
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue, Empty
 
 import serial
+from serial.tools import list_ports
+
+
+# Seconds the reader waits in readline before checking the timeouts
+READ_TIMEOUT = 0.1
+
+# Framed commands (see arenafw.ino): start byte, opcode, sequence
+# number, LED bitmask, int32 value and the XOR of the bytes before
+FRAME_START = 0xA5
+OP_PING = 0
+OP_MOVE = 1
+OP_ALIGN = 2
+OP_LEDS_ON = 3
+OP_LEDS_OFF = 4
+OP_PULSE = 5
+OP_STATUS = 6
+
+# Motor steps of one r/l letter command
+STEPS_PER_MOVE = 500
+
+# USB (vendor id, product id) of the arena controllers, None matches any
+# product: Arduino (Nano Every and others), Arduino.org and CH340 clones
+CONTROLLER_USB_IDS = [(0x2341, None), (0x2A03, None), (0x1A86, 0x7523)]
+
+# Seconds an arena has to answer the identity command. Boards that
+# reset when the port is opened are in their bootloader for up to ~2 s.
+HANDSHAKE_TIMEOUT = 2.5
+
+# Seconds between the identity commands of a handshake
+HANDSHAKE_RETRY = 0.25
+
+# Port of the last arena found, tried first the next time
+LAST_PORT_FILE = os.path.join(os.path.expanduser('~'), '.arenaprog', 'last_port')
+
+
+def make_frame(op, seq, mask=0, value=0):
+    '''Returns the bytes of a framed command
+    '''
+    frame = struct.pack('<BBBBi', FRAME_START, op, seq & 0xFF, mask, value)
+    check = 0
+    for byte in frame:
+        check ^= byte
+    return frame + bytes([check])
 
 
 class FakeSerial:
+    '''Stands in for the arena, replying one line per command letter or frame
+    '''
+    def __init__(self):
+        self.timeout = READ_TIMEOUT
+        self._replies = Queue()
+        self._target = 0
+        self._leds = 0
+
+    def _run_frame(self, frame):
+        start, op, seq, mask, value = struct.unpack('<BBBBi', frame[:8])
+        if op == OP_MOVE:
+            self._target += value
+        elif op == OP_ALIGN:
+            self._target -= 250
+        elif op in (OP_LEDS_ON, OP_PULSE):
+            self._leds |= mask
+        elif op == OP_LEDS_OFF:
+            self._leds &= ~mask
+        elif op == OP_STATUS:
+            return f'#{seq} ok {self._target} {self._target} 0 {self._leds}'
+        return f'#{seq} ok'
+
     def write(self, message):
-        return f'fakeserial: {message}'
+        i = 0
+        while i < len(message):
+            if message[i] == FRAME_START:
+                reply = self._run_frame(message[i:i+9])
+                i += 9
+            elif message[i:i+1] == b'?':
+                reply = 'arenafw 2 frames fake'
+                i += 1
+            else:
+                reply = f'fakeserial: {chr(message[i])}'
+                i += 1
+            self._replies.put(f'{reply}\r\n'.encode('ASCII'))
+        return len(message)
+
     def readline(self):
-        return ''
-
-def _say(ser, message):
-    ser.write(message.encode('ASCII'))
-    return ser.readline()
-
-def detect_controller_devices():
-    devs = []
-
-    system = platform.system()
-    if system == "Linux":
-        devs = [os.path.join('/dev', fn) for fn in os.listdir(
-            '/dev') if fn.startswith('ttyACM')]
-    elif system== "Windows":
-        coms = [f'COM{i}' for i in range(256)]
-        for com in coms:
+        try:
+            return self._replies.get(timeout=self.timeout)
+        except Empty:
+            return b''
+
+    def close(self):
+        pass
+
+
+class SerialLink:
+    '''Pipelined commands and replies over the serial port
+
+    The commands are written by a writer thread and the reply lines are
+    read by a reader thread, so send never blocks. The firmware handles
+    the command letters in order and replies one line to each, so the
+    replies are matched to the commands in the order they were sent.
+
+    If no reply comes within the timeout, the future of the command
+    fails with TimeoutError (once the line has been silent, so a reply
+    that is only slow is not given to the next command).
+
+    Attributes
+    ----------
+    ser : obj
+        The serial library object, with a read timeout
+    timeout : float
+        Seconds to wait for the replies of a command
+    '''
+    def __init__(self, ser, timeout=2.0):
+        self.ser = ser
+        self.timeout = timeout
+
+        self._commands = Queue()
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._running = True
+
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._writer.start()
+        self._reader.start()
+
+    def send(self, message, n_replies=None, callback=None, timeout=None):
+        '''Queue a command and return at once
+
+        Arguments
+        ---------
+        message : str or bytes
+            Command letters, or the bytes of framed commands
+        n_replies : int or None
+            Reply lines to wait for. If None, one per letter (required
+            for bytes).
+        callback : callable or None
+            Called with the future when the command is done. It runs in
+            the reader thread, so GUI code has to pass the work to the
+            main loop (for example with after).
+        timeout : float or None
+            Overrides the timeout of the link for this command
+
+        Returns a concurrent.futures.Future of the list of reply lines
+        '''
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        if not self._running:
+            future.set_exception(ConnectionError('The arena link is closed'))
+            return future
+
+        if isinstance(message, str):
+            message = message.encode('ASCII')
+        if n_replies is None:
+            n_replies = len(message)
+        if n_replies == 0:
+            future.set_result([])
+            self._commands.put((message, None))
+            return future
+
+        if timeout is None:
+            timeout = self.timeout
+        self._commands.put((message, [future, n_replies, timeout, []]))
+        return future
+
+    def request(self, message, n_replies=None, timeout=None):
+        '''Send a command and wait for its replies (blocking)
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        return self.send(message, n_replies, timeout=timeout).result(timeout+1)
+
+    def _write_loop(self):
+        while self._running:
+            try:
+                data, pending = self._commands.get(timeout=READ_TIMEOUT)
+            except Empty:
+                continue
+            if pending is not None:
+                # The deadline counts from the write, not from the queueing
+                pending[2] = time.perf_counter() + pending[2]
+                with self._lock:
+                    self._pending.append(pending)
             try:
-                ser = serial.Serial(com, 9600)
-                ser.close()
-                devs.append(com)
-            except:
+                self.ser.write(data)
+            except Exception as e:
+                if pending is not None:
+                    with self._lock:
+                        self._pending.remove(pending)
+                    pending[0].set_exception(e)
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                line = self.ser.readline()
+            except Exception as e:
+                self._fail_pending(e)
+                time.sleep(READ_TIMEOUT)
+                continue
+
+            if not line:
+                self._expire()
+                continue
+
+            with self._lock:
+                if not self._pending:
+                    continue
+                future, n_replies, deadline, replies = self._pending[0]
+                replies.append(line.decode('ASCII', errors='replace').strip())
+                if len(replies) < n_replies:
+                    continue
+                self._pending.popleft()
+
+            if not future.done():
+                future.set_result(replies)
+
+    def _expire(self):
+        now = time.perf_counter()
+        expired = []
+        with self._lock:
+            while self._pending and self._pending[0][2] < now:
+                expired.append(self._pending.popleft())
+        for future, n_replies, deadline, replies in expired:
+            future.set_exception(TimeoutError(
+                f'{len(replies)}/{n_replies} replies from the arena'))
+
+    def _fail_pending(self, exception):
+        with self._lock:
+            failed = list(self._pending)
+            self._pending.clear()
+        for future, n_replies, deadline, replies in failed:
+            future.set_exception(exception)
+
+    def close(self):
+        '''Stop the threads and close the serial port
+        '''
+        self._running = False
+        self._writer.join()
+        self._reader.join()
+        self._fail_pending(ConnectionError('The arena link is closed'))
+        self.ser.close()
+
+def _load_last_port():
+    try:
+        with open(LAST_PORT_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _save_last_port(device):
+    try:
+        os.makedirs(os.path.dirname(LAST_PORT_FILE), exist_ok=True)
+        with open(LAST_PORT_FILE, 'w') as f:
+            f.write(device)
+    except OSError as e:
+        print(f'Could not save the arena port: {e}')
+
+def _usb_id_matches(port, usb_ids):
+    for vid, pid in usb_ids:
+        if port.vid == vid and (pid is None or port.pid == pid):
+            return True
+    return False
+
+def is_arena_identity(reply):
+    '''Returns True if reply is an arena answer to the identity command
+
+    Firmware before the identity command answers "Unkown command".
+    '''
+    return reply.startswith('arenafw') or reply == 'Unkown command'
+
+def handshake(ser, timeout=HANDSHAKE_TIMEOUT):
+    '''Ask the firmware identity until it answers or the timeout runs out
+
+    Works on the bare serial port, before the SerialLink is started.
+    The identity command is repeated as a board that has just been
+    reset drops what it gets while in its bootloader. The answers to
+    the repeated commands are read away, so that they are not taken
+    as the replies of the next commands.
+
+    The deadline is checked after every line, so a device that never
+    stops sending (another sketch printing data) does not block.
+
+    Returns the identity reply or None
+    '''
+    read_timeout = ser.timeout
+    ser.timeout = HANDSHAKE_RETRY
+    identity = None
+    try:
+        deadline = time.perf_counter() + timeout
+        while identity is None and time.perf_counter() < deadline:
+            ser.write(b'?')
+            while time.perf_counter() < deadline:
+                line = ser.readline()
+                if not line:
+                    break
+                reply = line.decode('ASCII', errors='replace').strip()
+                if is_arena_identity(reply):
+                    identity = reply
+                    break
+
+        if identity is not None:
+            # The replies to the other '?' come within a read timeout
+            drain_end = time.perf_counter() + 2*HANDSHAKE_RETRY
+            while time.perf_counter() < drain_end and ser.readline():
                 pass
-    else:
-        raise NotImplementedError(f'Unkown system: {system}')
+    finally:
+        ser.timeout = read_timeout
+    return identity
+
+def detect_controller_devices(usb_ids=CONTROLLER_USB_IDS):
+    '''Returns the serial ports that can have an arena controller
+
+    Only lists the ports (no port is opened) and keeps the USB devices
+    with a vendor and product id in usb_ids. The port of the last
+    arena found comes first.
+    '''
+    devs = [port.device for port in sorted(list_ports.comports())
+            if _usb_id_matches(port, usb_ids)]
+
+    last_port = _load_last_port()
+    if last_port in devs:
+        devs.remove(last_port)
+        devs.insert(0, last_port)
     return devs
 
 
-def toggle_led(ser, i_led, value):
+def toggle_led(link, i_led, value):
     leds_off = ['a', 'b', 'c', 'd', 'e', 'f']
     leds_on = ['A', 'B', 'C', 'D', 'E', 'F']
     
@@ -49,53 +350,248 @@ def toggle_led(ser, i_led, value):
         message = leds_on[i_led]
     else:
         message = leds_off[i_led]
-    return _say(ser, message)
+    return link.send(message)
 
 
-def move_platform_up(ser, N_steps):
+def move_platform_up(link, N_steps):
     N_steps = int(round(N_steps))
-    return _say(ser, str('r'*N_steps))
+    return link.send(str('r'*N_steps))
 
-def move_platform_down(ser, N_steps):
+def move_platform_down(link, N_steps):
     N_steps = int(round(N_steps))
-    return _say(ser, str('l'*N_steps))
+    return link.send(str('l'*N_steps))
 
-def step_end_align(ser):
-    return _say(ser, 'x')
+def step_end_align(link):
+    return link.send('x')
 
 
 class Arena:
     '''Control the Alice Arena9
 
+    The commands return at once with a concurrent.futures.Future of
+    the reply lines (see SerialLink).
+
+    Firmware that answers the identity command "?" gets framed
+    commands: one command and one reply line whatever the number of
+    steps or LEDs. Older firmware gets the letter commands.
+
+    Without a device, the ports from detect_controller_devices are
+    tried in turn and the first one answering the identity command is
+    used (and remembered for the next time). With a device and
+    require_identity, RuntimeError is raised if the device does not
+    answer like an arena.
+
     Attributes
     ----------
     ser : obj
         The serial library object
+    link : SerialLink
+        Sends the commands and reads the replies in the background
+    device : str or None
+        The serial port of the arena
+    identity : str
+        The answer of the firmware to the identity command
+    framed : bool
+        True if the firmware takes the framed commands
     '''
-    def __init__(self, device=None, fake_serial=None):
+    def __init__(self, device=None, fake_serial=None, timeout=2.0,
+                 require_identity=False):
         
         self.pos = 0
         self.led_states = {}
+        self.device = None
+        self.identity = ''
+        self._status = None
+        self._status_time = None
+        self._status_future = None
+        self.framed = False
+        self._seqs = itertools.count()
         
         if fake_serial:
             self.ser = FakeSerial()
+            self._set_identity(handshake(self.ser))
+            self.link = SerialLink(self.ser, timeout=timeout)
             return
 
-        if device is None:
-            devs = detect_controller_devices()
-            if not devs:
-                raise RuntimeError("Could not detect the arena")
-            device = devs[0]
+        if device is not None:
+            if not self._connect(device, timeout, required=require_identity):
+                raise RuntimeError(f"No arena on {device}")
+            return
 
-        self.ser = serial.Serial(device, 9600)
-        
+        for device in detect_controller_devices():
+            if self._connect(device, timeout, required=True):
+                _save_last_port(device)
+                return
+        raise RuntimeError("Could not detect the arena")
+
+    def _connect(self, device, timeout, required):
+        '''Open the port and identify the firmware
+
+        required : bool
+            If True, close the port and return False when the identity
+            is not an arena one
+        '''
+        ser = serial.Serial()
+        ser.port = device
+        ser.baudrate = 9600
+        ser.timeout = READ_TIMEOUT
+        # Without DTR, most boards (and all on Windows) are not reset
+        # when the port is opened. The handshake waits for the others.
+        ser.dtr = False
+        try:
+            ser.open()
+            identity = handshake(ser)
+        except serial.SerialException:
+            ser.close()
+            if required:
+                return False
+            raise
+
+        if identity is None and required:
+            ser.close()
+            return False
+
+        self.ser = ser
+        self._set_identity(identity)
+        self.link = SerialLink(self.ser, timeout=timeout)
+        self.device = device
+        return True
+
+    def _set_identity(self, identity):
+        if identity is None:
+            return
+        self.identity = identity
+        self.framed = 'frames' in identity.split()
+
+    def send_frame(self, op, mask=0, value=0, callback=None):
+        '''Send a framed command
+
+        Returns a Future of the reply line, that fails with
+        RuntimeError if the arena did not acknowledge the frame
+        '''
+        seq = next(self._seqs) & 0xFF
+
+        ack = Future()
+        if callback is not None:
+            ack.add_done_callback(callback)
+
+        def check(future):
+            try:
+                reply = future.result()[0]
+            except Exception as e:
+                ack.set_exception(e)
+                return
+            if reply.split()[:2] == [f'#{seq}', 'ok']:
+                ack.set_result(reply)
+            else:
+                ack.set_exception(RuntimeError(
+                    f'Arena did not acknowledge frame {seq}: {reply}'))
+
+        self.link.send(make_frame(op, seq, mask, value), n_replies=1,
+                       callback=check)
+        return ack
         
 
     def set_led(self, i_led, value):
         '''Set an LED on or off
         '''
         self.led_states[i_led] = value
-        return toggle_led(self.ser, i_led, value)
+        if self.framed:
+            return self.send_frame(
+                    OP_LEDS_ON if value > 0 else OP_LEDS_OFF, mask=1 << i_led)
+        return toggle_led(self.link, i_led, value)
+
+    def pulse_leds(self, mask, duration_ms):
+        '''Switch LEDs on together and off again after duration_ms
+
+        With the framed commands the firmware times the pulse, so its
+        length does not depend on the link or on the GUI. Older
+        firmware gets the letters in one write and a timer for the
+        switch off.
+
+        Arguments
+        ---------
+        mask : int
+            Bit i set for the LED i
+        duration_ms : int
+            Time the LEDs are on in milliseconds
+
+        Returns a Future of the acknowledgement of the switch on
+        '''
+        leds = [i_led for i_led in range(self.get_N_leds()) if mask & (1 << i_led)]
+        for i_led in leds:
+            self.led_states[i_led] = False
+
+        if self.framed:
+            return self.send_frame(OP_PULSE, mask=mask, value=int(duration_ms))
+
+        on = ''.join('ABCDEF'[i_led] for i_led in leds)
+        off = on.lower()
+        timer = threading.Timer(duration_ms/1000, self.link.send, args=(off,))
+        timer.daemon = True
+        timer.start()
+        return self.link.send(on)
+
+    def refresh_status(self):
+        '''Ask the firmware status in the background
+
+        Returns a Future of the status dict (see status), that fails
+        with RuntimeError on firmware without the framed commands
+        '''
+        if not self.framed:
+            future = Future()
+            future.set_exception(RuntimeError('The arena firmware has no status command'))
+            return future
+
+        pending = self._status_future
+        if pending is not None and not pending.done():
+            return pending
+
+        status = Future()
+        # The target of the firmware is self.pos at the time of the
+        # request, as the frames are handled in order
+        pos = self.pos
+
+        def parse(ack):
+            try:
+                fields = ack.result().split()
+                position, target, moving, leds = [int(field) for field in fields[2:6]]
+            except Exception as e:
+                status.set_exception(e)
+                return
+            self._status = {
+                    'position': position,
+                    'target': target,
+                    'pos': pos + (position-target) / STEPS_PER_MOVE,
+                    'moving': bool(moving),
+                    'leds': {i_led: bool(leds & (1 << i_led))
+                             for i_led in range(self.get_N_leds())},
+                    }
+            self._status_time = time.perf_counter()
+            status.set_result(self._status)
+
+        self._status_future = status
+        self.send_frame(OP_STATUS, callback=parse)
+        return status
+
+    def status(self, max_age=0.5):
+        '''Returns the last status of the arena, refreshing it in the background
+
+        Never waits for the arena: if the cached status is older than
+        max_age seconds, a refresh is started and the cached one is
+        returned.
+
+        Returns a dict with the stepper position and target (motor
+        steps), pos (the position in the move units of Arena.pos,
+        counted from the last end-align), moving (bool) and leds
+        ({i_led: bool}), or None before
+        the first status (and always on firmware without the framed
+        commands)
+        '''
+        if self._status_time is None or time.perf_counter() - self._status_time > max_age:
+            if self.framed:
+                self.refresh_status()
+        return self._status
 
     def get_led(self, i_led):
         '''Returns True if the LED is on, otherwise False
@@ -121,27 +617,111 @@ class Arena:
 
         self.pos += N_steps
 
+        if self.framed and N_steps != 0:
+            return self.send_frame(
+                    OP_MOVE, value=int(round(N_steps))*STEPS_PER_MOVE)
+
         if N_steps > 0: 
-            return move_platform_up(self.ser, N_steps)
+            return move_platform_up(self.link, N_steps)
         elif N_steps < 0:
-            return move_platform_down(self.ser, -N_steps)
+            return move_platform_down(self.link, -N_steps)
     
     def step_end_align(self):
         '''Do the end align with little torque
         '''
         self.pos = 0
-        return step_end_align(self.ser)
+        if self.framed:
+            return self.send_frame(OP_ALIGN)
+        return step_end_align(self.link)
+
+    def close(self):
+        '''Stop the serial link and close the port
+        '''
+        self.link.close()
+
+
+class ArenaPool:
+    '''Several arenas driven from one process
+
+    Each arena has its own serial link threads, so the commands to
+    different rigs run concurrently. The rigs are addressed by their
+    rig ID, pool[rig_id].set_led(...), or all at once with broadcast.
+
+    The rig ID is the USB serial number of the controller (stable when
+    the boards are plugged in different ports) or the port name, unless
+    names maps one of them to a lab name.
+
+    Attributes
+    ----------
+    arenas : dict
+        Rig ID to Arena
+    '''
+    def __init__(self, devices=None, names=None, timeout=2.0):
+        if devices is None:
+            devices = detect_controller_devices()
+        if names is None:
+            names = {}
+        serial_numbers = {port.device: port.serial_number
+                          for port in list_ports.comports()}
+
+        def connect(device):
+            try:
+                return Arena(device, timeout=timeout, require_identity=True)
+            except (RuntimeError, serial.SerialException):
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(devices))) as executor:
+            arenas = list(executor.map(connect, devices))
+
+        self.arenas = {}
+        for device, arena in zip(devices, arenas):
+            if arena is None:
+                continue
+            rig_id = serial_numbers.get(device) or device
+            rig_id = names.get(rig_id, names.get(device, rig_id))
+            self.arenas[rig_id] = arena
+
+    def __getitem__(self, rig_id):
+        return self.arenas[rig_id]
+
+    def __iter__(self):
+        return iter(self.arenas)
+
+    def __len__(self):
+        return len(self.arenas)
+
+    @property
+    def rig_ids(self):
+        return list(self.arenas)
+
+    def broadcast(self, method, *args, rig_ids=None, **kwargs):
+        '''Call an Arena method on all (or the given) rigs
+
+        The commands are only queued, so they go out to all the rigs
+        at nearly the same time.
+
+        Example: pool.broadcast('pulse_leds', 0b1111, 1000)
+
+        Returns {rig_id: return value}, usually futures of the replies
+        '''
+        if rig_ids is None:
+            rig_ids = self.rig_ids
+        return {rig_id: getattr(self.arenas[rig_id], method)(*args, **kwargs)
+                for rig_id in rig_ids}
+
+    def close(self):
+        for arena in self.arenas.values():
+            arena.close()
 
 
 def main():
 
     arena = Arena()
-    ser = arena.ser
 
     while True:
         
         message = input('LETTER >> ')
-        print( _say(ser, message)) 
+        print(arena.link.request(message))
 
 
 if __name__ == "__main__":
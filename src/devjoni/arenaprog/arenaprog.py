@@ -2,6 +2,7 @@
 '''
 
 import sys
+import traceback
 import atexit
 import platform
 import random
@@ -13,16 +14,22 @@ from datetime import datetime
 import devjoni.guibase as gb
 from devjoni.hosguibase.video import VideoWidget
 
-from .arenalib import Arena
-from .cardstimgen import CardStimWidget
+from .arenalib import Arena, ArenaPool
+from .cardstimgen import CardStimWidget, DeckCache
+from .framering import FrameRing
+from .trialsignals import TrialSignals
+from .timinglog import TimingLog
+from .movement_detector import MovementDetector, is_right_choice
+from .debugdump import DebugDump
 
 import cv2
 
 #import an opensource package that detects cameras
 from cv2_enumerate_cameras import enumerate_cameras
 
-# Import the video capturing function
-from .video_capture_openCV import VideoCaptureAsync
+# Import the video capturing and writing functions
+from .video_capture_openCV import VideoCaptureAsync, FrameNormaliser
+from .video_encoder_openCV import VideoEncoderAsync
 
 #get the module to run multiprocessing
 #from multiprocessing import Process
@@ -47,7 +54,7 @@ def apply_homography(pt, H):
     x_, y_, w_ = H @ vec
     return x_ / w_, y_ / w_
 
-def run_video_preview(camera_index, q_video):
+def run_video_preview(camera_index, signals):
     """A definition that will be used to display the camera images as preview (not recording, just displaying).
     Please turn off before starting the recording"""
 
@@ -65,22 +72,23 @@ def run_video_preview(camera_index, q_video):
             break
         if cv2.getWindowProperty('preview', cv2.WND_PROP_VISIBLE) < 1:
             break
-        try:
-            msg = q_video.get_nowait()
-            if msg == "stop":
-                break
-        except Empty:
-            pass
+        if signals.is_set('stop_recording'):
+            break
 
     cv2.destroyAllWindows()
     vc.release()
 
 
-def create_calib_mask(camera_index=None, image=None, calib_background=None, vid_w = 1280, vid_h = 800):
+def create_calib_mask(camera_index=None, image=None, calib_background=None, vid_w = 1280, vid_h = 800, normalise=None, debug=None):
     '''Definition to create a mask based on the automatic detection of the location of the stimuli. 
     The mask is used for the movement detector to detect when the fly passes over the stimulus.
     Depening on the method chosen, get a mask to place over the movement detection images 
-    for the detection of the flie entering the stimulus location or use provided.'''
+    for the detection of the flie entering the stimulus location or use provided.
+    normalise --> FrameNormaliser used to bring the camera image to the recording size and orientation (a new one is made if not given).
+    debug --> DebugDump used to save the images used for making the mask and the mask (nothing is saved if not given or not enabled).'''
+
+    if debug is None:
+        debug = DebugDump()
 
     #if no image provided, we get our own from the camera
     if image is None:
@@ -105,13 +113,14 @@ def create_calib_mask(camera_index=None, image=None, calib_background=None, vid_
             
             #cv2.imshow("masking image", stimu_for_mask_image_GRAY) """
 
+        if normalise is None:
+            normalise = FrameNormaliser(vid_w, vid_h)
+
         vc_mask = VideoCaptureAsync(src=camera_index, width=vid_w, height=vid_h)
         vc_mask.start()
         rval, stimu_for_mask_image_temp = vc_mask.read()
-        stimu_for_mask_image_temp2=cv2.resize(stimu_for_mask_image_temp,(1280,800))
-        stimu_for_mask_image = cv2.flip(stimu_for_mask_image_temp2,180)
+        stimu_for_mask_image = normalise(stimu_for_mask_image_temp) #resize (if needed) and flip like in the recording
         stimu_for_mask_image_GRAY=cv2.cvtColor(stimu_for_mask_image, cv2.COLOR_BGR2GRAY)
-        cv2.imwrite("C:/Experiment/Image_for_mask.jpg", stimu_for_mask_image_GRAY)
         vc_mask.stop()
 
     else:
@@ -121,8 +130,8 @@ def create_calib_mask(camera_index=None, image=None, calib_background=None, vid_
         #make it gray (should not need to resize or flip as it comes directly from the recording)
         stimu_for_mask_image_GRAY=cv2.cvtColor(stimu_for_mask_image, cv2.COLOR_BGR2GRAY)
     
-    #save the image used for making the mask
-    cv2.imwrite("C:/Experiment/Image_for_mask.jpg", stimu_for_mask_image_GRAY)
+    #save the image used for making the mask (if debugging)
+    debug.save("Image_for_mask.jpg", stimu_for_mask_image_GRAY, force=True)
 
     #check if the background image was not given
     if calib_background is None:
@@ -154,7 +163,7 @@ def create_calib_mask(camera_index=None, image=None, calib_background=None, vid_
     #cv2.imshow("calib_mask", mask_clean)
     #print("Mask regions:", len(contours))
 
-    cv2.imwrite("C:/Experiment/Mask.jpg", mask_clean)
+    debug.save("Mask.jpg", mask_clean, force=True)
 
     #let the user know that the process is done
     print("Mask loop ended (check if Mask created is mentionned above)")
@@ -162,7 +171,7 @@ def create_calib_mask(camera_index=None, image=None, calib_background=None, vid_
     return mask_clean, stimu_for_mask_image #we return the mask and the image used to make it as we need it sometimes in other processes
 
 
-def movement_detect_flexi(masking=None, stimulus_image=None, q_video=None, mov_detec_q=None,stop_mov_detec_q=None,next_loop_q=None,time_limit=1,auto_reward="n",right_stimu_coord=None,wrong_stimu_coord=None,sensitivity=50,mini_size=5,maxi_size=300):
+def movement_detect_flexi(masking=None, stimulus_image=None, mov_detec_q=None, signals=None, time_limit=1,auto_reward="n",right_stimu_coord=None,wrong_stimu_coord=None,sensitivity=50,mini_size=5,maxi_size=300,downscale=1,debug=None):
     """Movement detection only in the area of the stimuli that allows for the determining of which of the stimuli the fly choose in a multiple stimuli experiment. It compares the first frame with the stimuli displayed with teh current frame (both covered with the same mask that keeps only the stimuli area visible)
     to locate where the image changed over the stimuli. In the case of multiple stimuli, this should allow for getting the location of the area that change to see if it is close to the centre of mass of which stimulus.
     time_limit --> The duration during which the object needs to be detected to trigger the reaction (reward and/or stopping the trial).
@@ -170,151 +179,133 @@ def movement_detect_flexi(masking=None, stimulus_image=None, q_video=None, mov_d
     mini_size --> minimum size (without unit) to be considered as a detected object.
     maxi_size --> maximum size (without unit) to be considered as a detected object.
     right_stimu_coord --> coordinates of the correct stimulus the fly should visit. It could be several pairs of coordinates if the fly needs to visit a sequence of stimuli within the same trial. The structure should be [[X1,Y1],[X2,Y2]].
-    wrong_stimu_coord --> coordinates of all the wrong stimuli. It could be several pairs of coordinates if there are several wrong stimuli within the trial. It could also include the right stimulus too within the wrong one (therefore it could include all the stimuli of the trial). The structure should be [[X1,Y1],[X2,Y2]]."""
+    wrong_stimu_coord --> coordinates of all the wrong stimuli. It could be several pairs of coordinates if there are several wrong stimuli within the trial. It could also include the right stimulus too within the wrong one (therefore it could include all the stimuli of the trial). The structure should be [[X1,Y1],[X2,Y2]].
+    signals --> TrialSignals object used to ask for rewards, to stop the recording and to receive the stop of the detection.
+    downscale --> integer factor to shrink the stimuli regions by before the analysis (1 keeps the full resolution). Only the regions around the stimuli of the mask are analysed.
+    debug --> DebugDump used to save the analysed images (at most once per second, in the background) and to print the details of each frame. Nothing is saved or printed if not given or not enabled."""
 
     #stop the definition if there is no mask passed
     if masking is None or stimulus_image is None:
         print("Please generate a mask and a stimulus image first") 
         return None
 
-    #clear the queue of signal to stop the detection loop
-    while not stop_mov_detec_q.empty():
-        stop_mov_detec_q.get_nowait()
+    #clear the signal to stop the detection loop
+    signals.clear('stop_detection')
+
+    if debug is None:
+        debug = DebugDump()
 
     #convert the stimulus image to grey
     stimulus_gray=cv2.cvtColor(stimulus_image, cv2.COLOR_BGR2GRAY)
     
     #create the stimulus image masked
     stimulus_masked = cv2.bitwise_and(stimulus_gray,stimulus_gray,mask = masking)
-    cv2.imwrite("C:/Experiment/Mask applied on stimulus image.jpg", stimulus_masked)
+    debug.save("Mask applied on stimulus image.jpg", stimulus_masked, force=True)
+
+    #prepare the detector. It finds once the regions around the stimuli in the mask, and then only analyses these regions in every frame
+    detector = MovementDetector(masking, stimulus_image, sensitivity=sensitivity, mini_size=mini_size, maxi_size=maxi_size, downscale=downscale)
 
     #In case of experiment with sequential visits to multipe stimuli within the same trial, there can be multiple right stimulus coordinate pairs given. So we get a counter for the one currently treated
     current_right_coords_index=0
 
+    #build once per trial, for each right stimulus, the matrix of the stimuli coordinates with the right one in the first row and the wrong ones after, so that the choice is a single distance computation
+    if wrong_stimu_coord is not None:
+        wrong_coords=np.asarray(wrong_stimu_coord, dtype=float).reshape(-1, 2)
+        choice_coords=[np.vstack([np.asarray(a_right_coord, dtype=float), wrong_coords]) for a_right_coord in right_stimu_coord]
+
     #set a switch to know when it is a new detection and that we need to take the time
     frame_detect_switch=0
 
     print("Start movement detection:", datetime.now())
 
-    while(True):
-
-        try:
-            curent_analyse_frame=mov_detec_q.get_nowait() #check if there is a frame available in the queue
-            current_frame_gray = cv2.cvtColor(curent_analyse_frame, cv2.COLOR_BGR2GRAY) #convert image to grey levels
-
-            #put the mask over the current frame
-            current_frame_masked = cv2.bitwise_and(current_frame_gray,current_frame_gray,mask = masking)
-
-            # --- Absolute difference with the frame of the stimulus frame with the mask ---
-            diff_stimu = cv2.absdiff(stimulus_masked, current_frame_masked)
-
-            # --- Threshold to extract changed pixels ---
-            _, changed_pix = cv2.threshold(diff_stimu, sensitivity, 255, cv2.THRESH_BINARY)
-            
-
-            # --- Clean noise ---
-            kernel_image = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5))
-            changed_pix = cv2.morphologyEx(changed_pix, cv2.MORPH_OPEN, kernel_image)   # remove specks
-            changed_pix = cv2.morphologyEx(changed_pix, cv2.MORPH_CLOSE, kernel_image)  # close small gaps
-            cv2.imwrite("C:/Experiment/Current frame analysed.jpg", changed_pix)
-            
-            # --- check size of each region and keept only the ones of apporpriate size---
-            # useful if projector or camera adds random flicker
-            contours_changes, _ = cv2.findContours(changed_pix, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            list_contour_kept=[]
-            for c_2 in contours_changes:
-                print("Contour size: ", cv2.contourArea(c_2))
-                if cv2.contourArea(c_2) < maxi_size and cv2.contourArea(c_2) > mini_size:  # keep only "real" stimuli, as determined by its size
-                    list_contour_kept.append(c_2)
-            print("number of object detected: ", len(list_contour_kept))
-
-            if len(list_contour_kept)==1: #if we detected only one object, we consider it is the fly and that it is a valid detection
+    #reused for every frame taken from the ring buffer
+    frame_buffer=np.empty(mov_detec_q.shape, dtype=mov_detec_q.dtype)
 
-                print("Movement detected on stimulus")
+    #count the frames analysed and the frames on which the analysis failed, to report them at the end
+    n_frames=0
+    n_errors=0
+    dropped_at_start=mov_detec_q.dropped
 
-                #if this is the first frame with a detection, we catch the time to use later to compute how long the detection lasts
-                if frame_detect_switch==0:
+    #wait (without using the CPU) for the frames sent by the recording, until the stop of the detection is asked
+    frames=mov_detec_q.frames(timeout=0.1, stop=lambda: signals.is_set('stop_detection'), out=frame_buffer)
 
-                    moment_detect=time.time() #grab the time
-                    frame_detect_switch+=1 #switch to 1 to indicate that there is a detection in progress
-                    #print("switch ON")
-                else: #if it is not the first frame with a detection
-                    print(f"Detection running for {time.time() - moment_detect:.2f}s")
-                    diff_time=(time.time() - moment_detect) #compute the duration of the change
+    for t_frame, curent_analyse_frame in frames:
 
-                    if diff_time>time_limit: #if it is not the first frame, then we check how long the detection lasted and if it is over the limit indicated. If so, we trigger the reward.
-                        
-                        if auto_reward=="y":
-                        
-                            if wrong_stimu_coord is None: #if the user wants the reward and the experiment is with a single stimulus (there is no wrong coordinate because there is no wrong stimulus), we send the reward
-                                next_loop_q.put("reward") #send the signal to trigger the reward
-                                time.sleep(1) #wait 1 second
-                                q_video.put("stop") #send the signal to stop the recording
-                                break #stop the loop
+        n_frames+=1
 
-                            else:#if there are several stimuli, we need to check which one was visited
+        # --- compare the frame and the stimulus image over the stimuli, clean the noise and keep only the changed regions of apporpriate size ---
+        # useful if projector or camera adds random flicker
+        try:
+            list_contour_kept = detector.process(curent_analyse_frame)
+        except Exception: #a frame that cannot be analysed is reported and skipped, the detection goes on with the next one
+            n_errors+=1
+            print(f"Movement detection failed on frame {n_frames} (error {n_errors}):")
+            traceback.print_exc()
+            continue
+        debug.save("Current frame analysed.jpg", detector.changed_image) #the image is only built when it is saved
+        debug.log("Contour sizes: ", detector.areas)
+        debug.log("number of object detected: ", len(list_contour_kept))
+
+        if len(list_contour_kept)==1: #if we detected only one object, we consider it is the fly and that it is a valid detection
+
+            debug.log("Movement detected on stimulus")
+
+            #if this is the first frame with a detection, we catch the time to use later to compute how long the detection lasts
+            if frame_detect_switch==0:
+
+                moment_detect=time.time() #grab the time
+                frame_detect_switch+=1 #switch to 1 to indicate that there is a detection in progress
+                #print("switch ON")
+            else: #if it is not the first frame with a detection
+                debug.log("Detection running for (s):", f"{time.time() - moment_detect:.2f}")
+                diff_time=(time.time() - moment_detect) #compute the duration of the change
+
+                if diff_time>time_limit: #if it is not the first frame, then we check how long the detection lasted and if it is over the limit indicated. If so, we trigger the reward.
+                    
+                    if auto_reward=="y":
+                    
+                        if wrong_stimu_coord is None: #if the user wants the reward and the experiment is with a single stimulus (there is no wrong coordinate because there is no wrong stimulus), we send the reward
+                            signals.post('reward') #send the signal to trigger the reward
+                            time.sleep(1) #wait 1 second
+                            signals.post('stop_recording') #send the signal to stop the recording
+                            break #stop the loop
 
-                                #compute the centre of the object detected
-                                M = cv2.moments(list_contour_kept[0])
-                                cX = int(M["m10"] / M["m00"])
-                                cY = int(M["m01"] / M["m00"])
-                                object_coords=[cX,cY]
+                        else:#if there are several stimuli, we need to check which one was visited
 
-                                #compute the distance of the detected object from the correct stimulus
-                                dist_to_right=np.linalg.norm(np.array(object_coords) - np.array(right_stimu_coord[current_right_coords_index]))
+                            #get the centre of the object detected (the detector computes it in the full frame coordinates)
+                            object_coords=list_contour_kept[0][1]
 
-                                #compute the distance between the object and every other stimuli (the right one could be included or not, it works in anycase)
-                                list_wrong_dists=[]
+                            #if the distance from the correct stimulus is inferior or equal to the distance from every other stimuli (the right one could be included or not, it works in anycase), this is a correct choice and we send the message to the reward process to do a reward
+                            if is_right_choice(object_coords, choice_coords[current_right_coords_index]): #if auto reward option is activated and the object is closer to the right stimulus centre than the wrong stimulus one, we give the reward
                                 
-                                for a_wrong_coord in wrong_stimu_coord:
-                                    list_wrong_dists.append(np.linalg.norm(np.array(object_coords) - np.array(a_wrong_coord)))
-
-                                #get the minimum distance from every other stimuli (including the right one or not) 
-                                min_wrong_dist=min(list_wrong_dists)
+                                signals.post('reward') #send the signal to trigger the reward
+                                time.sleep(1) #wait 1 second for the reward duration (maybe increase it if we want to give time to the fly to get out of this stimulus)
 
-                                #if the distance from the correct stimulus is inferior or equal to the distance from every other stimuli (including the right one or not), this is a correct choice and we send the message to the reward process to do a reward
-
-                                if dist_to_right<= min_wrong_dist: #if auto reward option is activated and the object is closer to the right stimulus centre than the wrong stimulus one, we give the reward
-                                    
-                                    next_loop_q.put("reward") #send the signal to trigger the reward
-                                    time.sleep(1) #wait 1 second for the reward duration (maybe increase it if we want to give time to the fly to get out of this stimulus)
-
-                                    #check if this was the last correct stimulus the fly had to visit in this trial or if there are more. If it is the last one, we stop the trial.
-                                    if len(right_stimu_coord)==current_right_coords_index+1:
-                                        q_video.put("stop") #send the signal to stop the recording
-                                        break #stop the loop
-                                    else: #if there are more stimuli the fly hs to visit next, we add 1 to the index of the right coordinate to treat 
-                                        current_right_coords_index+=1
-
-                                else: #if the fly chose the wrong stimulus, we stop the trial
-                                    q_video.put("stop") #send the signal to stop the recording
+                                #check if this was the last correct stimulus the fly had to visit in this trial or if there are more. If it is the last one, we stop the trial.
+                                if len(right_stimu_coord)==current_right_coords_index+1:
+                                    signals.post('stop_recording') #send the signal to stop the recording
                                     break #stop the loop
-   
+                                else: #if there are more stimuli the fly hs to visit next, we add 1 to the index of the right coordinate to treat 
+                                    current_right_coords_index+=1
 
-            elif len(list_contour_kept)==0:  #if there is no detection in the currect frame, set (or reset) the switch to 0
-                #set the switch to 0
-                frame_detect_switch=0
-                #print("switch OFF")
-            else: #if there is more than one object detected, we consider that there is a problem. We set the switch to 0 and tell the user
-                #set the switch to 0
-                frame_detect_switch=0
-                print("Multiple object detected. Check the issue (size of detected objects, bugs, etc)")
+                            else: #if the fly chose the wrong stimulus, we stop the trial
+                                signals.post('stop_recording') #send the signal to stop the recording
+                                break #stop the loop
+   
 
-        except: #if the queue was empty, pass
-            pass
-            #print("no frame yet")
+        elif len(list_contour_kept)==0:  #if there is no detection in the currect frame, set (or reset) the switch to 0
+            #set the switch to 0
+            frame_detect_switch=0
+            #print("switch OFF")
+        else: #if there is more than one object detected, we consider that there is a problem. We set the switch to 0 and tell the user
+            #set the switch to 0
+            frame_detect_switch=0
+            debug.log("Multiple object detected. Check the issue (size of detected objects, bugs, etc)")
 
-        #to stop the loop, user can push the q key
-        if (cv2.waitKey(1) & 0xFF == ord('q')):
-            break
+    print(f"Stop movement detection: {datetime.now()}, {n_frames} frames analysed, {n_errors} errors, {mov_detec_q.dropped - dropped_at_start} frames skipped because the detection was too slow")
 
-        # Or check if stop was requested by clicking the stop button
-        try:
-            msg_mov = stop_mov_detec_q.get_nowait()
-            if msg_mov == "stop":
-                break
-        except Empty:
-            pass
+    #write the debug images still waiting to be saved
+    debug.close()
             
 
 #this process to detect objects over a single stimulus is a little too sensitive. The other process works better (now adapted for both single and double stimuli)
@@ -407,7 +398,7 @@ def movement_detect_flexi(masking=None, stimulus_image=None, q_video=None, mov_d
             pass """
 
 
-def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_rate=10, save_path=None, working_folder=os.getcwd(), name_of_video="Video.avi", indiv_name="Fly1", trial_number=None, save_codec='XVID', full_exp='n', auto_detection='n',mov_detec_q=None,stop_mov_detec_q=None,next_card_q=None,next_loop_q=None,q_video=None):
+def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_rate=10, detect_rate=1, save_path=None, working_folder=os.getcwd(), name_of_video="Video.avi", indiv_name="Fly1", trial_number=None, save_codec='XVID', full_exp='n', auto_detection='n',mov_detec_q=None,signals=None):
     '''Used to record videos using the opencv package.
     Optional parameters:
     duration --> (in seconds) if user wants to stop the recording after a given duration. If 0, the recording needs to be stopped manually.
@@ -415,15 +406,16 @@ def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_
     vid_h --> recording height in pixels.
     preview_rate --> rate of frames from the recording that will also be displayed to the user. 
                     By default every 10 frames will be displayed. A lower number will increase the strain on the system and may slowe down the recording rate.
+    detect_rate --> rate of frames from the recording that are passed to the movement detector. By default every frame is analysed.
     save_path --> character string of the full path of the video to be saved (folder path + video name + extention, usually .avi)
     working_folder --> used if the full path is not given, to create a path from information given in the gui
     save_codec --> codec to use to save the video. 'XVID' and 'DIVX' works. Check to see what else is available. Please change the file expension accordingly.
-    It needs several queues to communicate with the various processes around the recording:
-    mov_detec_q --> to pass images to the movement detector process
-    stop_mov_detec_q --> used to send a stop message to the movement detector if teh recording process is terminated
-    next_card_q --> in the case of automatising the full experiment it is used to trigger the display of stimuli
-    next_loop_q --> in the case of automatising the full experiment it is used to signal that the recording of the trial is done and we can move to teh next one
-    q_video --> used to send stop signals from the gui process to the recording and preview process'''
+    It needs to communicate with the various processes around the recording:
+    mov_detec_q --> FrameRing (shared memory ring buffer) to pass images to the movement detector process
+    signals --> TrialSignals object. In the case of automatising the full experiment it is used to trigger the display of stimuli (camera_ready), 
+                to wait for the stimulus before to record (stimulus_shown) and to signal that the recording of the trial is done and we can move to teh next one (trial_done).
+                It also carries the stop signals from the gui process to the recording (stop_recording) and from the recording to the movement detector (stop_detection).
+    Next to the video, a <video>.timing.csv sidecar gets the capture time of every frame written and the trial events (stimulus onset, rewards, stops) on the same clock.'''
     
     
     # If no path was provided, get it from the widget
@@ -450,13 +442,12 @@ def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_
     #close the opencv windows that were already open (like if we made a previsualisation one) before to start recording
     cv2.destroyAllWindows()
 
-    #clear the queue of images for movement detection
+    #clear the ring buffer of images for movement detection
     if auto_detection=="y":
-        while not mov_detec_q.empty():
-            mov_detec_q.get_nowait()
+        mov_detec_q.clear()
 
-    #Intiate Video Capture object
-    capture = VideoCaptureAsync(src=camera, width=vid_w, height=vid_h)
+    #Intiate Video Capture object (zero copy as the frames are resized and flipped into new images right away)
+    capture = VideoCaptureAsync(src=camera, width=vid_w, height=vid_h, zero_copy=True)
     #capture = cv2.VideoCapture(camera)
     
 
@@ -476,28 +467,31 @@ def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_
     """ while not capture.isOpened():
         print("waiting for capture to start") """
 
-    
-    #start the writer (the saved video will play at 20fps, the real duration of the video will be saved in a text file)
-    out = cv2.VideoWriter(save_path, fourcc, 20, (vid_w,vid_h))
+    #start the encoder thread. The frames go through a bounded queue so a slow encoding never stalls the capture, and the writer is opened only once the first frames 
+    #have been captured, so the saved video plays at the measured frame rate of the camera
+    encoder = VideoEncoderAsync(save_path, fourcc, (vid_w,vid_h))
+    encoder.start()
+
+    #resize (only if the camera does not deliver the right size already) and flip the frames into reused buffers. There are enough buffers for all the frames 
+    #that can wait in the encoder queue, plus the one being encoded and the current one.
+    normalise = FrameNormaliser(vid_w, vid_h, n_buffers=encoder.max_queue+2)
+
+    #open the timing sidecar and forget the events from before this recording
+    timing = TimingLog(str(save_path)+'.timing.csv')
+    signals.drain_events()
 
     #if this recording is part of an automtised full experiment process, send the signal to display (change) the stimulus and wait for the signal to start recording
     if full_exp=="y":
-        next_card_q.put("GO!")
+        signals.post('camera_ready')
         print("Go:", datetime.now())
 
-        #wait to receive a signal to start recording
-        while(True):
-            #check if teh signal to start recording is sent
-            try:
-                msg_start_record = next_card_q.get_nowait()
-                if msg_start_record == "Record!":
-                    time.sleep(0.15) #Wait a bit as the refresh rate of the projector may create a dilay in the display of the stimulus
-                    break
-            except Empty:
-                pass
+        #sleep until the signal to start recording is sent (or the recording is stopped before that)
+        if signals.wait('stimulus_shown', 'stop_recording') == 'stimulus_shown':
+            time.sleep(0.15) #Wait a bit as the refresh rate of the projector may create a dilay in the display of the stimulus
 
     #get the time when the recording starts
     time_start = time.time()
+    timing.event(time.perf_counter(), 'recording_start')
 
     #if the user mentionned a maximum duration we compute the end time, otherwise we give one in 10 years (an crazy far so we don't have to worry about the recording stopping on its own)
     if duration!=0:
@@ -506,6 +500,9 @@ def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_
         time_end = time.time() + 3.154e+8
 
     frames = 0
+    video_frames = 0
+    missed_frames = 0
+    last_seq = None
 
     #Create array to hold frames from capture
     #images = []
@@ -514,59 +511,83 @@ def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_
 
     # Capture for duration defined by variable 'duration'
     while time.time() <= time_end:
-        ret, new_frame = capture.read()
-        frame = cv2.resize(new_frame,(1280,800))
-        frame = cv2.flip(frame,180)
-        #images.append(new_frame)
-        out.write(frame)
-        
+        #sleep until the camera delivers a frame that was not written yet, so every captured frame is written only once
+        ret, new_frame, seq, t_frame, pos_msec = capture.read_next(timeout=0.5)
+
+        #if no new frame arrived in time, we only check the stop conditions below
+        if ret:
+            #if the seq counter jumped, the camera captured frames that this loop was too slow to read
+            if last_seq is not None and seq - last_seq > 1:
+                missed_frames += seq - last_seq - 1
+                timing.event(t_frame, f'frames_missed:{seq - last_seq - 1}')
+            last_seq = seq
+            frame = normalise(new_frame)
+            #images.append(new_frame)
+
+            #pass the frame to the encoder and save its capture time (or that it was dropped because the encoder lags too much) and the events that happened since the last frame
+            if encoder.write(frame, t_frame):
+                timing.frame(video_frames, t_frame, pos_msec)
+                video_frames += 1
+            else:
+                timing.event(t_frame, 'frame_dropped')
+            for t_event, label in signals.drain_events():
+                timing.event(t_event, label)
 
-        # Here only every 10th frame is shown on the display. Change the preview_rate to a value suitable to the project by passing the value in the function. 
-        # The higher the number, the more processing required and the slower it becomes
-        if frames ==0 or frames%preview_rate == 0:
-            # This project used a Pitft screen and needed to be displayed in fullscreen. 
-            # The larger the frame, higher the processing and slower the program.
-            # Uncomment the following line if you have a specific display window in mind. 
-            #frame = cv2.resize(new_frame,(1280,800))
-            #frame = cv2.flip(frame,180)
             #if the autodetection is wanted send frames to the process for analyses
-            if auto_detection=="y":
-                mov_detec_q.put(frame) #put the frame in the queue for movement detection analysis
-            cv2.imshow('frame', frame)
+            if auto_detection=="y" and frames%detect_rate == 0:
+                mov_detec_q.put(frame, t_frame) #copy the frame in the shared ring buffer for movement detection analysis (only the slot index and timestamp go through the locks)
+
+            # Here only every 10th frame is shown on the display. Change the preview_rate to a value suitable to the project by passing the value in the function. 
+            # The higher the number, the more processing required and the slower it becomes
+            if frames ==0 or frames%preview_rate == 0:
+                # This project used a Pitft screen and needed to be displayed in fullscreen. 
+                # The larger the frame, higher the processing and slower the program.
+                # Uncomment the following line if you have a specific display window in mind. 
+                #frame = cv2.resize(new_frame,(1280,800))
+                #frame = cv2.flip(frame,180)
+                cv2.imshow('frame', frame)
+
+                #the window events are processed only with the preview frames (waitKey takes at least 1ms, too long to do at every frame at 100fps)
+                if cv2.waitKey(1) & 0xFF == ord('q'): #press q to stop the process
+                    break
+                #or check that the display window has been manually closed by the user
+                if frames>20 and cv2.getWindowProperty('frame',cv2.WND_PROP_VISIBLE) < 1: #we added a frame delay because the window takes time to appear and thus this line stops the loop after one frame (even if we put frames>1 it is not enough)
+                    break
+
+            #add 1 to the frame counter
+            frames += 1
 
-        #add 1 to the frame counter
-        frames += 1
-        
-        if cv2.waitKey(1) & 0xFF == ord('q'): #press q to stop the process
-            break
-        #or check that the display window has been manually closed by the user
-        if frames>20 and cv2.getWindowProperty('frame',cv2.WND_PROP_VISIBLE) < 1: #we added a frame delay because the window takes time to appear and thus this line stops the loop after one frame (even if we put frames>1 it is not enough)
-            break
         # Or check if stop was requested by clicking the stop button
-        try:
-            msg = q_video.get_nowait()
-            if msg == "stop":
-                break
-        except Empty:
-            pass
+        if signals.is_set('stop_recording'):
+            break
 
     capture.stop()
     #capture.release()
 
     cv2.destroyAllWindows()
 
+    #wait for the encoder to write the frames still in its queue and to close the file
+    encoder.stop()
+
     # The fps variable which counts the number of frames and divides it by 
     # the duration gives the frames per second which is used to record the video later.
     time_total=time.time() - time_start
     fps = round(frames/time_total,2)
 
-    #pass a stop signal to the movement detector loop, through its dedicated queue
-    stop_mov_detec_q.put("stop")
+    #pass a stop signal to the movement detector loop
+    signals.post('stop_detection')
+
+    #close the timeline with the last events
+    timing.event(time.perf_counter(), 'recording_end')
+    for t_event, label in signals.drain_events():
+        timing.event(t_event, label)
+    timing.close()
 
     print(frames)
     #print(len(images)) 
     print(time_total)
     print(fps)
+    print("Frames dropped by the encoder:", encoder.dropped, "- maximum encoder queue depth:", encoder.high_water)
     # The following line initiates the video object and video file named 'video.avi' 
     # of width and height declared at the beginning.
     """ out = cv2.VideoWriter(save_path, fourcc, fps, (vid_w,vid_h))
@@ -585,11 +606,21 @@ def record_video_cv2(camera=None,duration=0, vid_w = 1280, vid_h = 800, preview_
         f.write("Fps: " + str(fps))
         f.write('\n')
         f.write("Duration (s): " + str(time_total))
+        f.write('\n')
+        f.write("Video file fps: " + str(round(encoder.fps,2)))
+        f.write('\n')
+        f.write("Frames in the video file: " + str(encoder.written))
+        f.write('\n')
+        f.write("Missed camera frames: " + str(missed_frames))
+        f.write('\n')
+        f.write("Frames dropped by the encoder: " + str(encoder.dropped))
+        f.write('\n')
+        f.write("Encoder queue high-water mark: " + str(encoder.high_water))
 
     print("Done")
 
     if full_exp=="y":
-        next_loop_q.put("GO!")
+        signals.post('trial_done')
 
 
 class MovementView(gb.FrameWidget):
@@ -617,6 +648,19 @@ class MovementView(gb.FrameWidget):
 
         align = gb.ButtonWidget(self, 'End-align', self.do_align)
         align.grid(row=i+2, column=0)
+
+        #position reported by the arena firmware, polled from its cached status
+        self.status_text = gb.TextWidget(self, '')
+        self.status_text.grid(row=i+3, column=0)
+        self.update_status()
+
+    def update_status(self):
+        status = self.arena.status()
+        if status is not None:
+            moving = ' (moving)' if status['moving'] else ''
+            #in the same units as the position label above (one move is STEPS_PER_MOVE motor steps)
+            self.status_text.set(text=f"Arena at {status['pos']:.1f}{moving}")
+        self.after(500, self.update_status)
         
 
     def move(self, N_steps):
@@ -653,18 +697,23 @@ class LightView(gb.FrameWidget):
         state = not state
 
         self.arena.set_led(i_led, state)
+        self.show_led(i_led, state)
 
+    def show_led(self, i_led, state):
         if state:
             self.led_buttons[i_led].set(bg='green')
         else:
             self.led_buttons[i_led].set(bg='gray')
 
-    def do_reward(self, repeat=True):
+    def do_reward(self, duration_ms=1000):
+        '''Pulse the reward LEDs (1 to 4) in one command timed by the arena
+        '''
+        self.arena.pulse_leds(0b1111, duration_ms)
         for i_led in range(4):
-            self.toggle(i_led)
-        if repeat:
-            self.after(1000, lambda : self.do_reward(False))
-            self.parent.parent.stop_clock()
+            self.show_led(i_led, True)
+        #the buttons only show the pulse, the arena switches the LEDs off
+        self.after(duration_ms, lambda : [self.show_led(i_led, False) for i_led in range(4)])
+        self.parent.parent.stop_clock()
 
 
 class StimView(gb.FrameWidget):
@@ -696,10 +745,26 @@ class StimView(gb.FrameWidget):
                 command=self.generate_cards)
         self.b_generate.grid(row=2, column=0)
         
-        self.preview = CardStimWidget(self, 100, 100)
+        #generated decks are saved in ~/.arenaprog/decks and reused for the same seed
+        self.deck_cache = DeckCache()
+
+        self.preview = CardStimWidget(self, 100, 100, deck_cache=self.deck_cache)
         self.preview.grid(row=2, column=1)
         self.preview.next_card_callback = self.next_card_callback
 
+        #seed of the cards, the same seed gives the same cards again (loaded from the deck cache)
+        self.seed_text = gb.TextWidget(self, 'Seed (empty: random):')
+        self.seed_text.grid(row=3, column=0, sticky='WE')
+
+        self.seed = gb.EntryWidget(self)
+        self.seed.set_input('')
+        self.seed.grid(row=3, column=1)
+        self.last_seed = None
+
+        #progress of the decks being saved in the deck cache, or the seed of the last cards
+        self.deck_status = gb.TextWidget(self, '')
+        self.deck_status.grid(row=4, column=0, columnspan=2)
+
 
         self.view = None
 
@@ -730,19 +795,42 @@ class StimView(gb.FrameWidget):
             except:
                 pass
 
-        seed = random.random()
+        #use the seed given by the user or a new random one (shown to be able to reuse it)
+        try:
+            seed = int(self.seed.get_input().strip())
+        except (ValueError, AttributeError):
+            seed = random.randrange(1000000)
+        self.last_seed = seed
+        print("Cards seed:", seed)
 
-        self.preview.card_methods[self.active_type](seed=seed,nb_card=number_trials)
-        #self.preview.next_card(do_callback=False) #muted as we want to be able to do the heavy lifting of generating cards long before to display the first one
-    
+        #generate the deck once, at the resolution of the largest view (the stimulus window if it is open), and share it with the preview that shows the same cards downscaled
         if self.view:
             self.view[1].card_methods[self.active_type](seed=seed,nb_card=number_trials)
-            #self.view[1].next_card(do_callback=False) #muted as we want to be able to do the heavy lifting of generating cards long before to display the first one
+            self.preview.set_deck(self.view[1].deck)
+        else:
+            self.preview.card_methods[self.active_type](seed=seed,nb_card=number_trials)
+        self.update_deck_status()
+        #no next_card here as we want to be able to do the heavy lifting of generating cards long before to display the first one
         
         #start the chronometer
         #self.parent.start_clock()
 
 
+    def update_deck_status(self):
+        '''Show the progress of the deck saving until it is done
+        '''
+        saving = self.deck_cache.saving()
+        if saving:
+            n_done = sum(done for done, total in saving.values())
+            n_total = sum(total for done, total in saving.values())
+            self.deck_status.set(text=f'Saving cards {n_done}/{n_total}')
+            self.after(200, self.update_deck_status)
+        elif self.last_seed is not None:
+            self.deck_status.set(text=f'Seed of the cards: {self.last_seed}')
+        else:
+            self.deck_status.set(text='')
+
+
     #definition to create place the calibration display in the opened stimulus window
     def generate_calib(self,relat_size=0.1, XX=100, YY=100):
 
@@ -793,7 +881,8 @@ class StimView(gb.FrameWidget):
         #toplevel = gb.MainWindow(parent=root,fullscreen=False,frameless=True,window_geom="1280x800+1920+0") #for actual display on the projector
 
         
-        view = CardStimWidget(toplevel, 400, 400, make_nextbutton=False)
+        view = CardStimWidget(toplevel, 400, 400, make_nextbutton=False,
+                              deck_cache=self.deck_cache)
         #view.b_next.destroy()
         view.grid()
 
@@ -814,8 +903,10 @@ class CameraControlView(gb.FrameWidget):
     ----------
     camera_view : obj or None
         A CameraView Widget to be controlled
+    camera : int
+        Index of the camera used first (the rig's camera with --multirig)
     '''
-    def __init__(self, parent, arena,stim, camera_view=None):
+    def __init__(self, parent, arena,stim, camera_view=None, camera=0):
         super().__init__(parent)
 
         self.arena = arena
@@ -937,34 +1028,32 @@ class CameraControlView(gb.FrameWidget):
         """ self.trying_btn = gb.ButtonWidget(self, text='Trying stuff', command=self.trying_stuff)
         self.trying_btn.grid(row=14, column=0, columnspan=3) """
 
-        #start the queue manager for the multiprocessing
-        manager = multiprocessing.Manager()
-
         #get the list of active camras
         self.camera_list=enumerate_cameras(cv2.CAP_MSMF)
 
-        #set the camera number as the first one
+        #set the camera number as the one given (the first one by default)
         if len(self.camera_list)<1: #if there are no camera detected, let the user know
             print('No camera detected')
-        else: #if there are cameras, select the first one and print its info
-            self.camera=0
+        else: #if there are cameras, select the given one and print its info
+            if not 0 <= camera < len(self.camera_list):
+                print(f'Camera {camera} not found, using the first one')
+                camera = 0
+            self.camera=camera
             print(self.camera_list[self.camera])
         
-        #create a queue so we can pass stoping messages to the video preview and recording threads.
-        self.q_video = manager.Queue()
-        self.stop_mov_detec_q = manager.Queue() #same to stop the movement detector thread
+        #create the signals shared with the video preview, recording and movement detector processes (stop messages, reward requests, start of the trials...). 
+        #Waiting on them sleeps instead of spinning a cpu core.
+        self.signals = TrialSignals()
 
-        #create a queue so we can pass images from the cam to the movement detector
-        self.mov_detec_q = manager.Queue()
+        #create a shared memory ring buffer so we can pass images from the cam to the movement detector without pickling them
+        self.mov_detec_q = FrameRing(shape=(800, 1280, 3))
+        atexit.register(self.mov_detec_q.close)
 
-        #create a queue to pass a signal to change the stimulus card at the right moment in the recording process
-        self.next_card_q = manager.Queue()
+        #debug images and messages, only if the program was started with --debug-dump [folder]
+        self.debug = DebugDump.from_argv(sys.argv)
 
-        #create a queue to pass the signal to start the next loop (trial) in the automatic running of the full experiment.
-        self.next_loop_q = manager.Queue()
-
-        #create a queue to pass the signal to stop the full experiment (automatic) process.
-        self.stop_full_exp_q = manager.Queue()
+        #create the stage that brings the camera images of the calibrations to the size and orientation of the recordings
+        self.normalise = FrameNormaliser(1280, 800)
 
         #create a list to store the calibration coordinates
         self.calib_coord=[]
@@ -974,20 +1063,18 @@ class CameraControlView(gb.FrameWidget):
         self.reward_lights=LightView(self.parent,self.arena)
     
     """ def trying_stuff(self):
-        index = self.stim.view[1].cards.index(self.stim.view[1].current_card)
-        print(index)
+        print(self.stim.view[1].current_index)
         print(self.stim.active_type)
         print(self.stim.view[1].right_stimu_coords) """
 
     def play(self):
         # Clear any leftover stop signals
-        while not self.q_video.empty():
-            self.q_video.get_nowait()
+        self.signals.clear('stop_recording')
 
         self.disable_controls()
 
         # Start external function in a new process
-        thrd_preview = multiprocessing.Process(target=run_video_preview, args=(self.camera, self.q_video),daemon=True)
+        thrd_preview = multiprocessing.Process(target=run_video_preview, args=(self.camera, self.signals),daemon=True)
         thrd_preview.start()
         
     
@@ -995,8 +1082,7 @@ class CameraControlView(gb.FrameWidget):
         '''function that starts the recording process in a new thread so the main gui stays responsive.'''
 
         # Clear any leftover stop signals
-        while not self.q_video.empty():
-            self.q_video.get_nowait()
+        self.signals.clear('stop_recording')
 
         #get the video name and the path
         video_name=self.filename.get_input().strip() or None
@@ -1030,50 +1116,25 @@ class CameraControlView(gb.FrameWidget):
                 thrd_detect.start() """
 
                 #start the tracking process
-                thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":self.image_for_making_mask, "q_video":self.q_video,"mov_detec_q":self.mov_detec_q, "stop_mov_detec_q":self.stop_mov_detec_q,"next_loop_q":self.next_loop_q, "time_limit":autoD_duration,"auto_reward":activ_autoR,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
+                thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":self.image_for_making_mask, "mov_detec_q":self.mov_detec_q, "signals":self.signals, "debug":self.debug, "time_limit":autoD_duration,"auto_reward":activ_autoR,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
                 thrd_detect.start()
             
             #if its an experiment with more than one stumulus, start the process
             if self.stim.active_type>=3:
                 
-                #get the list of right stimuli coordinates and wrong stimuli coordinates
-                all_right_coords_orig=self.stim.view[1].right_stimu_coords
-                all_wrong_coords_orig=self.stim.view[1].wrong_stimu_coords
-                
-                #convert the right stimuli coordinates
-                all_right_coord_convert = [
-                    [
-                        apply_homography(pair, self.h)
-                        for pair in inner
-                    ]
-                    for inner in all_right_coords_orig
-                ]
-
-                #convert the right stimuli coordinates
-                all_wrong_coord_convert = [
-                    [
-                        apply_homography(pair, self.h)
-                        for pair in inner
-                    ]
-                    for inner in all_wrong_coords_orig
-                ]
-
-                #get the response of the user in the gui about the sensitivity to changes in the movement detector and the duration of changes before triggering the reward
-                autoD_duration=float(self.detect_duration.get_input().strip())
-                
-                #get the index of the card currently displayed
-                index = self.stim.view[1].cards.index(self.stim.view[1].current_card)
+                #get the right and wrong stimuli coordinates of the card currently displayed
+                card_metadata=self.stim.view[1].current_metadata
 
-                #get the coordinates of the correct and incorrect stimuli
-                right_coord_convert=all_right_coord_convert[index]
-                wrong_coord_convert=all_wrong_coord_convert[index]
+                #convert the coordinates of the correct and incorrect stimuli from the stimulus window to the camera coordinate system
+                right_coord_convert=[apply_homography(pair, self.h) for pair in card_metadata["right_stimu_coords"]]
+                wrong_coord_convert=[apply_homography(pair, self.h) for pair in card_metadata["wrong_stimu_coords"]]
 
                 #start the tracking process
-                thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":self.image_for_making_mask, "q_video":self.q_video,"mov_detec_q":self.mov_detec_q, "stop_mov_detec_q":self.stop_mov_detec_q,"next_loop_q":self.next_loop_q, "time_limit":autoD_duration,"auto_reward":activ_autoR,"right_stimu_coord":right_coord_convert,"wrong_stimu_coord":wrong_coord_convert,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
+                thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":self.image_for_making_mask, "mov_detec_q":self.mov_detec_q, "signals":self.signals, "debug":self.debug, "time_limit":autoD_duration,"auto_reward":activ_autoR,"right_stimu_coord":right_coord_convert,"wrong_stimu_coord":wrong_coord_convert,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
                 thrd_detect.start()
 
         #start the recording using a new thread from the cpu so the main GUI stays active, pass the optional arguments to the function
-        thrd_record = multiprocessing.Process(target=record_video_cv2,kwargs={"camera":self.camera, "working_folder":folder_path, "name_of_video":video_name, "indiv_name":individual_name,"save_path": None, "save_codec": "DIVX", "auto_detection":activ_autoD, "mov_detec_q":self.mov_detec_q, "stop_mov_detec_q":self.stop_mov_detec_q, "next_card_q":self.next_card_q, "next_loop_q":self.next_loop_q, "q_video":self.q_video}, daemon=True)
+        thrd_record = multiprocessing.Process(target=record_video_cv2,kwargs={"camera":self.camera, "working_folder":folder_path, "name_of_video":video_name, "indiv_name":individual_name,"save_path": None, "save_codec": "DIVX", "auto_detection":activ_autoD, "mov_detec_q":self.mov_detec_q, "signals":self.signals}, daemon=True)
         thrd_record.start()
 
         if activ_autoR=="y":
@@ -1085,7 +1146,7 @@ class CameraControlView(gb.FrameWidget):
         '''function to to the recording and/or the preview'''
         #trigger a stop for the while loop in the preview_video_cv2() or the record_video_cv2() functions
         #Send a stop signal to the video thread
-        self.q_video.put("stop")
+        self.signals.post('stop_recording')
 
         #stop clock if it is running
         self.parent.parent.stop_clock()
@@ -1095,24 +1156,20 @@ class CameraControlView(gb.FrameWidget):
 
 
     def check_automatic_reward(self,):
-        #wait for the end of the recording to move to the new trial
+        #sleep until the movement detector asks for a reward
         while(True):
-            # check if signal to trigger the reward or to move to the next trial was sent (when the recording started)
-            try:
-                msg_next_loop = self.next_loop_q.get_nowait()
-                if msg_next_loop == "reward":
-                    print("Doing reward") #inform the user that we trigger the reward
-                    self.reward_lights.do_reward() #trigger the reward
-                    time.sleep(1) #wait 1 second
-            except Empty:
-                pass
+            if self.signals.wait('reward') == 'reward':
+                print("Doing reward") #inform the user that we trigger the reward
+                self.reward_lights.do_reward() #trigger the reward
+                self.signals.mark('reward_given') #save the moment of the reward in the timeline of the recording
+                time.sleep(1) #wait 1 second
 
 
     def stop_full_experiment_process(self):
         '''function to stop the automatic run of the full experiment (full set of trials). Including the recording currently running.'''
         #trigger a stop for the full experiment loop and to stop the recording 
-        self.stop_full_exp_q.put("stop")
-        self.q_video.put("stop")
+        self.signals.post('stop_experiment')
+        self.signals.post('stop_recording')
 
         #stop the clock
         self.parent.parent.stop_clock()
@@ -1189,8 +1246,7 @@ class CameraControlView(gb.FrameWidget):
 
             #get the first image and reformat it to the correct size
             rval, calib_temp = vc.read()
-            calib_temp=cv2.resize(calib_temp,(1280,800))
-            calib = cv2.flip(calib_temp,180)
+            calib = self.normalise(calib_temp)
 
             #show the image optained
             cv2.imshow("calib", calib)
@@ -1279,10 +1335,9 @@ class CameraControlView(gb.FrameWidget):
         vc_calib.start()
         #time.sleep(0.5) #wait for the camera to adjust to the light
         rval, auto_calib_image = vc_calib.read()
-        auto_calib_image_temp=cv2.resize(auto_calib_image,(1280,800))
-        auto_calib_image_temp2 = cv2.flip(auto_calib_image_temp,180)
+        auto_calib_image_temp2 = self.normalise(auto_calib_image)
         self.auto_calib_image_GRAY=cv2.cvtColor(auto_calib_image_temp2, cv2.COLOR_BGR2GRAY)
-        cv2.imwrite("C:/Experiment/Calib_image.jpg", self.auto_calib_image_GRAY)
+        self.debug.save("Calib_image.jpg", self.auto_calib_image_GRAY, force=True)
         vc_calib.stop()
         #close the video capture and the window
         cv2.destroyAllWindows()
@@ -1297,7 +1352,7 @@ class CameraControlView(gb.FrameWidget):
         return(self.auto_calib_image_GRAY)
     
     def run_create_calib_mask(self):
-        self.mask, self.image_for_making_mask=create_calib_mask(camera_index=self.camera,calib_background=self.auto_calib_image_GRAY)
+        self.mask, self.image_for_making_mask=create_calib_mask(camera_index=self.camera,calib_background=self.auto_calib_image_GRAY,debug=self.debug)
         #thrd_mask = multiprocessing.Process(target=create_calib_mask, args=, daemon=True)
         #thrd_mask.start()
 
@@ -1313,9 +1368,8 @@ class CameraControlView(gb.FrameWidget):
     #make a definition that run the full display and recording process for the number of trials indicated
     def full_experiment_process(self):
         
-        #clear the queue of sigal to stop the full experiment
-        while not self.stop_full_exp_q.empty():
-            self.stop_full_exp_q.get_nowait()
+        #clear the signal to stop the full experiment
+        self.signals.clear('stop_experiment')
 
         #get the video name and the path
         video_name=self.filename.get_input().strip() or None
@@ -1378,35 +1432,35 @@ class CameraControlView(gb.FrameWidget):
         #for each trials
         for i in range(nb_trial_to_run):
         
-            #clear the queue of signal to display the next stimulus
-            while not self.next_card_q.empty():
-                self.next_card_q.get_nowait()
-
-            #clear the queue of signal to move to the next loop
-            while not self.next_loop_q.empty():
-                self.next_loop_q.get_nowait()
+            #clear the signals of the previous trial (display of the stimulus, rewards, end of the trial and the stop of the previous recording)
+            self.signals.clear('camera_ready', 'stimulus_shown', 'reward', 'trial_done', 'stop_recording')
 
             #reset the filter image to None
             first_stim_image=None
         
             #start the recording using a new thread from the cpu so the main GUI stays active, pass the optional arguments to the function
-            thrd_record = multiprocessing.Process(target=record_video_cv2,kwargs={"camera":self.camera, "working_folder":folder_path, "name_of_video":video_name, "indiv_name":individual_name, "trial_number": i, "save_codec": "DIVX","full_exp":"y", "auto_detection":activ_autoD, "mov_detec_q":self.mov_detec_q, "stop_mov_detec_q":self.stop_mov_detec_q, "next_card_q":self.next_card_q, "next_loop_q":self.next_loop_q, "q_video":self.q_video}, daemon=True)
+            thrd_record = multiprocessing.Process(target=record_video_cv2,kwargs={"camera":self.camera, "working_folder":folder_path, "name_of_video":video_name, "indiv_name":individual_name, "trial_number": i, "save_codec": "DIVX","full_exp":"y", "auto_detection":activ_autoD, "mov_detec_q":self.mov_detec_q, "signals":self.signals}, daemon=True)
             thrd_record.start()
 
-            #wait for the end of the recording process to start to display the stimulus
-            while(True):
-                # check if signal to display the next stimulus was sent (when the recording started)
-                try:
-                    msg_disp_card = self.next_card_q.get_nowait()
-                    if msg_disp_card == "GO!":
-                        break
-                except Empty:
-                    pass
+            #get the converted coordinates of the correct and incorrect stimuli of the card coming up, before the timing critical part between the display of the stimulus and the start of the recording
+            if activ_autoD=="y" and self.stim.active_type>=3:
+                next_index=self.stim.view[1].peek_next()["index"]
+                right_coord_convert=all_right_coord_convert[next_index]
+                wrong_coord_convert=all_wrong_coord_convert[next_index]
+
+            #sleep until the recording process has started to display the stimulus (or the experiment is stopped)
+            if self.signals.wait('camera_ready', 'stop_experiment') == 'stop_experiment':
+                #the recording was stopped together with the experiment, do not show the next card
+                break
 
             #display the next stimulus
             self.stim.view[1].next_card(do_callback=False)
             self.stim.preview.next_card(do_callback=False)
             print("Stimuli displayed:", datetime.now())
+            #save which card was shown, the deck can be found again from its key
+            deck_key=self.stim.view[1].deck.key
+            if deck_key is not None:
+                self.signals.mark(f"card:{deck_key}:{self.stim.view[1].current_index}")
             #wait for the display window to be updated
             self.stim.view[0].tk.update_idletasks()
             self.stim.view[0].tk.update()
@@ -1415,13 +1469,13 @@ class CameraControlView(gb.FrameWidget):
             self.parent.parent.start_clock()
             
             #send the signal to start recording
-            self.next_card_q.put("Record!")
+            self.signals.post('stimulus_shown')
 
             #wait for the first image of the recording to generate the filter (need to make sure that the first image is capture shortly after the display of teh stimulus not before)
             while(first_stim_image is None):
                 try:
                     #get the first image of the camera (which should have the stimulus displayed, otherwise we may want to put a wait time) to use for creating the filter
-                    first_stim_image = self.mov_detec_q.get_nowait()
+                    _, first_stim_image = self.mov_detec_q.get(timeout=1)
                 except Empty:
                     pass
 
@@ -1429,7 +1483,7 @@ class CameraControlView(gb.FrameWidget):
             if activ_autoD=="y":
 
                 #create a new mask for the new stimulus display
-                self.mask,self.first_stim_image=create_calib_mask(image=first_stim_image, camera_index=self.camera,calib_background=self.auto_calib_image_GRAY)
+                self.mask,self.first_stim_image=create_calib_mask(image=first_stim_image, camera_index=self.camera,calib_background=self.auto_calib_image_GRAY,debug=self.debug)
 
                 if self.stim.active_type<3:
             
@@ -1438,52 +1492,37 @@ class CameraControlView(gb.FrameWidget):
                     thrd_detect.start() """
 
                     #start the movement detection process
-                    thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":first_stim_image, "q_video":self.q_video,"mov_detec_q":self.mov_detec_q, "stop_mov_detec_q":self.stop_mov_detec_q,"next_loop_q":self.next_loop_q, "time_limit":autoD_duration,"auto_reward":activ_autoR,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
+                    thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":first_stim_image, "mov_detec_q":self.mov_detec_q, "signals":self.signals, "debug":self.debug, "time_limit":autoD_duration,"auto_reward":activ_autoR,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
                     thrd_detect.start()
 
                 #if the autodetection is wanted and its an experiment with more than one stumulus, start the process
                 if self.stim.active_type>=3:
-   
-                    #get the index of the card currently displayed
-                    index = self.stim.view[1].cards.index(self.stim.view[1].current_card)
-
-                    #get the converted coordinates of the correct and incorrect stimuli
-                    right_coord_convert=all_right_coord_convert[index]
-                    wrong_coord_convert=all_wrong_coord_convert[index]
-
 
                     #start the tracking process
-                    thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":first_stim_image, "q_video":self.q_video,"mov_detec_q":self.mov_detec_q, "stop_mov_detec_q":self.stop_mov_detec_q,"next_loop_q":self.next_loop_q, "time_limit":autoD_duration,"auto_reward":activ_autoR,"right_stimu_coord":right_coord_convert,"wrong_stimu_coord":wrong_coord_convert,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
+                    thrd_detect = multiprocessing.Process(target=movement_detect_flexi,kwargs={"masking":self.mask, "stimulus_image":first_stim_image, "mov_detec_q":self.mov_detec_q, "signals":self.signals, "debug":self.debug, "time_limit":autoD_duration,"auto_reward":activ_autoR,"right_stimu_coord":right_coord_convert,"wrong_stimu_coord":wrong_coord_convert,"sensitivity":autoD_sensitivity,"mini_size":autoD_mini_size,"maxi_size":autoD_maxi_size}, daemon=True)
                     thrd_detect.start()
 
             #Save the card displayed
 
 
-            #wait for the end of the recording to move to the new trial
+            #sleep until the end of the recording to move to the new trial, doing the rewards asked in the meantime
             while(True):
-                # check if signal to trigger the reward or to move to the next trial was sent (when the recording started)
-                try:
-                    msg_next_loop = self.next_loop_q.get_nowait()
-                    if msg_next_loop == "GO!":
-                        break
-                    elif msg_next_loop == "reward":
-                        print("Doing reward") #inform the user that we trigger the reward
-                        self.reward_lights.do_reward() #trigger the reward
-                        time.sleep(1) #wait 1 second
-                except Empty:
-                    pass
+                msg_next_loop = self.signals.wait('trial_done', 'reward')
+                if msg_next_loop == 'trial_done':
+                    break
+                elif msg_next_loop == 'reward':
+                    print("Doing reward") #inform the user that we trigger the reward
+                    self.reward_lights.do_reward() #trigger the reward
+                    self.signals.mark('reward_given') #save the moment of the reward in the timeline of the recording
+                    time.sleep(1) #wait 1 second
             
             #stop the display of the current stimulus before the display of teh next one
             self.stim.preview.current_card.grid_remove()
             self.stim.view[1].current_card.grid_remove()
 
             #check if the stop signal for the full experiment was triggered (if so, the signal to stop the recording should also have been sent and we should arrive here). 
-            try:
-                msg = self.stop_full_exp_q.get_nowait()
-                if msg == "stop":
-                    break
-            except Empty:
-                pass
+            if self.signals.is_set('stop_experiment'):
+                break
             
             #self.stim.view[1].tk.destroy()
 
@@ -1641,14 +1680,19 @@ class FastCameraView(gb.FrameWidget):
 
 
 class TotalView(gb.FrameWidget):
-    def __init__(self, parent, do_camera=True):
+    def __init__(self, parent, do_camera=True, arena=None, rig_id=None, camera=0):
         super().__init__(parent)
 
-
-        try:
-            arena = Arena()
-        except:
-            arena = Arena(fake_serial=True)
+        #an arena can be given (one view per rig of an ArenaPool), otherwise the first one found is used
+        #without an arena, the camera and the stimuli still work with a fake one (the LEDs and the platform do nothing)
+        if arena is None:
+            try:
+                arena = Arena()
+            except Exception as e:
+                print(f"WARNING: No arena found ({e}). Using a fake arena, the LEDs and the platform are NOT controlled")
+                arena = Arena(fake_serial=True)
+            atexit.register(arena.close)
+        self.rig_id = rig_id
         
         # Motion control side
 
@@ -1674,7 +1718,7 @@ class TotalView(gb.FrameWidget):
             camerabox = gb.FrameWidget(self)
             camerabox.grid(row=1, column=1, rowspan=2)
         
-            control = CameraControlView(camerabox,arena,stim)
+            control = CameraControlView(camerabox,arena,stim,camera=camera)
             control.grid(row=0, column=0, sticky='')
 
             #camera = FastCameraView(camerabox)
@@ -1685,7 +1729,7 @@ class TotalView(gb.FrameWidget):
 
         self.time = 0
         self.clock_running=False
-        self.time_widget = gb.TextWidget(self, 'Time (s)')
+        self.time_widget = gb.TextWidget(self, 'Time (s)' if rig_id is None else f'Rig {rig_id} - Time (s)')
         self.time_widget.grid(row=0, column=0, sticky='WE')
 
     def start_clock(self):
@@ -1698,7 +1742,10 @@ class TotalView(gb.FrameWidget):
 
     def update_clock(self):
         self.time += 0.1
-        self.time_widget.set(text=f'{self.time:.2f} seconds')
+        if self.rig_id is None:
+            self.time_widget.set(text=f'{self.time:.2f} seconds')
+        else:
+            self.time_widget.set(text=f'Rig {self.rig_id} - {self.time:.2f} seconds')
         if self.clock_running:
             self.after(100, self.update_clock)
         """ else:
@@ -1719,6 +1766,21 @@ class TotalView(gb.FrameWidget):
         self.clock_running = False
 
 
+def cameras_from_argv(argv):
+    '''Returns the camera index of each rig given with "--cameras 0,1"
+
+    Without the option, only the first rig has a camera (index 0). An
+    empty index ("--cameras 0,,1") leaves that rig without a camera.
+    '''
+    if '--cameras' not in argv:
+        return [0]
+    i = argv.index('--cameras')
+    if i+1 >= len(argv):
+        return [0]
+    return [int(index) if index.strip() else None
+            for index in argv[i+1].split(',')]
+
+
 def main():
 
     window = gb.MainWindow()
@@ -1733,8 +1795,25 @@ def main():
         do_camera = True
 
 
-    view = TotalView(window, do_camera=do_camera)
-    view.grid()
+    #with --multirig, one view per arena connected to this computer, side by side
+    #each camera can only be opened by one view, "--cameras 0,1" gives the camera of each rig in order
+    pool = None
+    if '--multirig' in sys.argv:
+        pool = ArenaPool()
+        atexit.register(pool.close)
+
+    if pool:
+        cameras = cameras_from_argv(sys.argv)
+        for i_rig, rig_id in enumerate(pool):
+            camera = cameras[i_rig] if i_rig < len(cameras) else None
+            if do_camera and camera is None:
+                print(f"Rig {rig_id} has no camera (give one with --cameras), only its arena is controlled")
+            view = TotalView(window, do_camera=do_camera and camera is not None,
+                             arena=pool[rig_id], rig_id=rig_id, camera=camera)
+            view.grid(row=0, column=i_rig)
+    else:
+        view = TotalView(window, do_camera=do_camera)
+        view.grid()
 
     window.run()
 
@@ -0,0 +1,69 @@
+'''Micro-benchmark of the stimulus card generation.
+
+Times, per card, the description of a multipie deck, the drawing of
+the cards with render_card and, for comparison, building the cards by
+pasting pies from a glyph atlas (drawn once per size and variation).
+The time of an empty card shows the part that no drawing method can
+save.
+
+    python -m devjoni.arenaprog.bench_cards [n_cards]
+'''
+
+import sys
+import timeit
+
+from PIL import Image
+
+from .cardstimgen import describe_multipie_cards, render_card, _draw_pie
+
+
+def atlas_render(spec, atlas):
+    '''Builds the multipie card by pasting the pies from the atlas
+    '''
+    image = Image.new('RGB', (spec.width, spec.height))
+    for kind, box, variation in spec.shapes:
+        x0, y0, x1, y1 = [int(round(v)) for v in box]
+        key = (x1-x0, y1-y0, variation)
+        mask = atlas.get(key)
+        if mask is None:
+            mask = Image.new('L', (x1-x0+1, y1-y0+1))
+            _draw_pie(mask, 0, 0, x1-x0, y1-y0, variation)
+            atlas[key] = mask
+        image.paste('white', (x0, y0, x0+mask.width, y0+mask.height),
+                    mask=mask)
+    return image
+
+
+def per_card(func, n_cards):
+    return min(timeit.repeat(func, number=1, repeat=5)) / n_cards * 1000
+
+
+def main():
+    n_cards = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    for width, height in ((400, 400), (1280, 800)):
+        specs = describe_multipie_cards(
+                4, 4, width=width, height=height, nb_card=n_cards)
+        atlas = {}
+
+        t_describe = per_card(
+                lambda: describe_multipie_cards(
+                    4, 4, width=width, height=height, nb_card=n_cards),
+                n_cards)
+        t_draw = per_card(
+                lambda: [render_card(spec) for spec in specs], n_cards)
+        t_atlas = per_card(
+                lambda: [atlas_render(spec, atlas) for spec in specs], n_cards)
+        t_empty = per_card(
+                lambda: [Image.new('RGB', (width, height)) for spec in specs],
+                n_cards)
+
+        print(f"{n_cards} multipie cards of {width}x{height}, ms/card:")
+        print(f"  describe    {t_describe:7.3f}")
+        print(f"  draw        {t_draw:7.3f}")
+        print(f"  atlas paste {t_atlas:7.3f}")
+        print(f"  empty card  {t_empty:7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+'''Micro-benchmark of the per-frame cost of the movement detection.
+
+Compares the full frame processing that movement_detect_flexi did
+before with MovementDetector, on synthetic frames with a fly over one
+of the stimuli. Needs only cv2 and numpy (no GUI, camera or arena).
+
+    python -m devjoni.arenaprog.bench_movement_detector [n_frames]
+'''
+
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from .movement_detector import MovementDetector, is_right_choice
+
+
+WIDTH = 1280
+HEIGHT = 800
+STIMULI = [[400, 400], [880, 400]]
+
+
+def make_scene():
+    '''Returns the mask, the stimulus image and a frame with a fly
+    '''
+    mask = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    stimulus = np.full((HEIGHT, WIDTH, 3), 40, dtype=np.uint8)
+    for x, y in STIMULI:
+        cv2.circle(mask, (x, y), 120, 255, -1)
+        cv2.circle(stimulus, (x, y), 120, (220, 220, 220), -1)
+
+    frame = stimulus.copy()
+    cv2.circle(frame, (STIMULI[0][0]+30, STIMULI[0][1]), 6, (0, 0, 0), -1)
+    return mask, stimulus, frame
+
+
+def full_frame_process(mask, stimulus_masked, frame,
+                       sensitivity=50, mini_size=5, maxi_size=300):
+    '''The per-frame work of movement_detect_flexi before MovementDetector
+
+    Like it did, builds the morphology kernel again for every frame.
+    '''
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    masked = cv2.bitwise_and(gray, gray, mask=mask)
+    diff = cv2.absdiff(stimulus_masked, masked)
+    _, changed = cv2.threshold(diff, sensitivity, 255, cv2.THRESH_BINARY)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5))
+    changed = cv2.morphologyEx(changed, cv2.MORPH_OPEN, kernel)
+    changed = cv2.morphologyEx(changed, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(
+            changed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    objects = []
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if mini_size < area < maxi_size:
+            M = cv2.moments(contour)
+            objects.append(
+                    (area, [int(M["m10"]/M["m00"]), int(M["m01"]/M["m00"])]))
+    return objects
+
+
+def loop_choice(object_coords, right_coord, wrong_coords):
+    '''The right/wrong decision of movement_detect_flexi before is_right_choice
+    '''
+    dist_to_right = np.linalg.norm(np.array(object_coords) - np.array(right_coord))
+    wrong_dists = [np.linalg.norm(np.array(object_coords) - np.array(c))
+                   for c in wrong_coords]
+    return dist_to_right <= min(wrong_dists)
+
+
+def timeit(func, n):
+    func()
+    start = time.perf_counter()
+    for i in range(n):
+        func()
+    return (time.perf_counter()-start) / n
+
+
+def main():
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    mask, stimulus, frame = make_scene()
+    stimulus_gray = cv2.cvtColor(stimulus, cv2.COLOR_BGR2GRAY)
+    stimulus_masked = cv2.bitwise_and(stimulus_gray, stimulus_gray, mask=mask)
+
+    print(f"{n_frames} frames of {WIDTH}x{HEIGHT}, {len(STIMULI)} stimuli")
+    t_full = timeit(
+            lambda: full_frame_process(mask, stimulus_masked, frame),
+            n_frames)
+    print(f"full frame        {t_full*1000:7.3f} ms/frame")
+    t_kernel = timeit(
+            lambda: cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5)),
+            n_frames)
+    print(f"  of which kernel {t_kernel*1e6:7.1f} us")
+
+    for downscale in (1, 2, 4):
+        detector = MovementDetector(mask, stimulus, downscale=downscale)
+        t = timeit(lambda: detector.process(frame), n_frames)
+        print(f"ROIs downscale {downscale}  {t*1000:7.3f} ms/frame"
+              f"  ({t_full/t:.1f}x)  {detector.process(frame)}")
+
+    object_coords = [STIMULI[0][0]+30, STIMULI[0][1]]
+    choice_coords = np.asarray([STIMULI[0]] + STIMULI, dtype=float)
+    t_loop = timeit(
+            lambda: loop_choice(object_coords, STIMULI[0], STIMULI), n_frames)
+    t_vec = timeit(
+            lambda: is_right_choice(object_coords, choice_coords), n_frames)
+    print(f"choice loop       {t_loop*1e6:7.1f} us")
+    print(f"choice vectorised {t_vec*1e6:7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,18 +8,37 @@ patters and images.
 
 Use somthing else for high-framerate moving stimuli or long videos.
 '''
+import os
+import json
 import math
 import random
+import shutil
+import hashlib
+import threading
+import tkinter as tk
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
 import numpy as np
 
 from PIL import Image, ImageDraw
 
 import devjoni.guibase as gb
 
+from .imagecache import IMAGE_CACHE
+
 
 CARD_WIDTH = 200
 CARD_HEIGHT = 200
 
+# Candidate positions tried before giving up placing a stimulus
+MAX_PLACEMENT_ATTEMPTS = 10000
+
+# Default number of processes drawing the deck files. Kept small so that
+# a deck generated during an experiment leaves the CPUs to the capture,
+# the encoding and the movement detection.
+RENDER_WORKERS = 2
+
 
 def _calc_variations(N):
     '''Calculate the pie binary variations
@@ -58,12 +77,11 @@ def _draw_pie(image, x0, y0, x1, y1, variation):
     x0, y1, x1, y1 : int
         Coordinates of the area filled with the pie
     variation : string
-        Variation of the pie, for example "0101"
+        Variation of the pie, for example "0101", already rotated
+        (see _randomize_rotation)
     '''
     ctx = ImageDraw.Draw(image)
 
-    variation = _randomize_rotation(variation)
-
     opening = 360 / len(variation)
     
     for i_boolean, boolean in enumerate(variation):
@@ -71,53 +89,225 @@ def _draw_pie(image, x0, y0, x1, y1, variation):
             ctx.pieslice(
                     [(x0,y0),(x1,y1)],
                     i_boolean*opening, (i_boolean+1)*opening,
-                    fill=(255,255,255))
+                    fill='white')
 
     w = x1-x0
     h = y1-y0
 
     cp = [int(w/2+x0),int(h/2+y0)]
     r = int(min(w/2,h/2))
-    ctx.circle(cp,r)
+    ctx.circle(cp,r,outline='white')
 
 
-def create_centraldot_images(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
-                             seed=None,nb_card=10):
+class CardSpec:
+    '''Description of a card, cheap to create and to keep
+
+    All the random choices of a card are made when its CardSpec is
+    created. The card is drawn only when it is needed, with
+    render_card.
+
+    Attributes
+    ----------
+    width, height : int
+        Size of the card in pixels
+    shapes : list of tuple
+        White shapes drawn on a black card, in order. One of
+        ("circle", [cX, cY], radius), ("rectangle", [x0, y0, x1, y1]),
+        ("line", [x0, y0, x1, y1]) or ("pie", [x0, y0, x1, y1], variation)
+    image : Image or None
+        Ready-made Pillow image used instead of the shapes
+    path : str or None
+        Image file of the card (from a DeckCache), used instead of the
+        shapes if it can be read
+    '''
+    def __init__(self, width, height, shapes=None, image=None, path=None):
+        self.width = width
+        self.height = height
+        self.shapes = shapes if shapes is not None else []
+        self.image = image
+        self.path = path
+
+    def to_json(self):
+        '''Returns the description as a JSON compatible dict
+        '''
+        return {'width': self.width, 'height': self.height,
+                'shapes': [list(shape) for shape in self.shapes]}
+
+    @classmethod
+    def from_json(cls, data, path=None):
+        return cls(data['width'], data['height'], data['shapes'], path=path)
+
+
+def _load_card_file(fn):
+    with Image.open(fn) as image:
+        return image.convert('RGB')
+
+
+def _image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def render_card(spec):
+    '''Draw the card described by the CardSpec
+
+    A card with an image file is read through IMAGE_CACHE, the returned
+    image is then shared and must not be drawn on.
+
+    Returns a Pillow image
+    '''
+    if spec.image is not None:
+        return spec.image
+
+    if spec.path is not None:
+        try:
+            return IMAGE_CACHE.get(spec.path, _load_card_file,
+                                   nbytes=_image_nbytes)
+        except OSError as e:
+            print(f'Could not read {spec.path} ({e}), drawing the card')
+
+    image = Image.new('RGB', (spec.width, spec.height))
+    ctx = ImageDraw.Draw(image)
+
+    for shape in spec.shapes:
+        kind = shape[0]
+        if kind == 'circle':
+            ctx.circle(shape[1], shape[2], fill=(255,255,255))
+        elif kind == 'rectangle':
+            ctx.rectangle(shape[1], fill=(255,255,255))
+        elif kind == 'line':
+            ctx.line(shape[1], fill=(255,255,255))
+        elif kind == 'pie':
+            _draw_pie(image, *shape[1], shape[2])
+        else:
+            raise ValueError(f'Unknown card shape: {kind}')
+
+    return image
+
+
+class PlacementError(ValueError):
+    '''No position satisfying the placement rules was found for a stimulus
+    '''
+
+
+def _placement_rng():
+    # Numpy generator following the seed of the random module (setseed)
+    return np.random.default_rng(random.getrandbits(64))
+
+
+def place_point(rng, width, height, margin, avoid=(),
+                max_attempts=MAX_PLACEMENT_ATTEMPTS, batch=64):
+    '''Returns a random [X, Y] position for a stimulus on the card
+
+    Candidates are drawn by batches and tested all at once against the
+    minimum distances, and the first one passing is returned.
+
+    Arguments
+    ---------
+    rng : numpy.random.Generator
+        Source of the random positions
+    width, height : int
+        Card size
+    margin : int
+        Minimum distance of the position to the card edges
+    avoid : sequence
+        (point, min_distance) pairs. The position is kept at least
+        min_distance away from each point. Any number of points can be
+        given, for example all the stimuli already placed on this card
+        and the previous card.
+    max_attempts : int
+        Maximum number of candidates to try
+
+    Raises PlacementError if no candidate passes within max_attempts.
+    '''
+    if 2*margin >= min(width, height):
+        raise PlacementError(
+                f'A stimulus with a margin of {margin} pixels does not fit '
+                f'on a {width}x{height} card')
+
+    points = np.array([point for point, dist in avoid], dtype=float).reshape(-1, 2)
+    min_dists = np.array([dist for point, dist in avoid], dtype=float)
+
+    tried = 0
+    while tried < max_attempts:
+        n = min(batch, max_attempts-tried)
+        tried += n
+
+        candidates = np.empty((n, 2), dtype=int)
+        candidates[:,0] = rng.integers(margin, width-margin, n)
+        candidates[:,1] = rng.integers(margin, height-margin, n)
+
+        dists = np.hypot(
+                candidates[:,None,0] - points[None,:,0],
+                candidates[:,None,1] - points[None,:,1])
+        ok = np.flatnonzero((dists >= min_dists).all(axis=1))
+        if ok.size:
+            return candidates[ok[0]].tolist()
+
+    rules = ', '.join(f'{dist:g} px from {list(point)}' for point, dist in avoid)
+    raise PlacementError(
+            f'No position found in {max_attempts} attempts for a stimulus '
+            f'with a margin of {margin} px on a {width}x{height} card '
+            f'(at least {rules}). Use smaller stimuli or a larger card.')
+
+
+def describe_centraldot_cards(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
+                              seed=None, nb_card=10):
     '''
     r_rel : float
         Radius relative to the smallest image dimension, width or height
+
+    Returns a list of CardSpec
     '''
 
-    images = []
+    specs = []
 
     setseed(seed)
+    rng = _placement_rng()
 
     #create a fake dot centre at the corner of the drawing window to use for the first distance comparison of the first dot location
     cp=[0,0]
     
     for i in range(nb_card):
-        image = Image.new('RGB', (width, height))
-        ctx = ImageDraw.Draw(image)
-        
         R = int(r_rel*min(width, height)/2)
-        cp_temp = [int((width-R*2)*random.random()+R),
-              int((height-R*2)*random.random()+R)]
-        
-        #as long as the centre of the centre of the new dot is less than 8 times the radius of the dot from the centre of the previous dot, 
-        # we recompute a new centre (np.linalg.norm between two points give teh euclidean distance)
-        while np.linalg.norm(np.array(cp_temp) - np.array(cp))<8*R: 
-            cp_temp = [int((width-R*2)*random.random()+R),
-              int((height-R*2)*random.random()+R)]
-            
-        #once we have found a good new centre, we save it as cp
-        cp=cp_temp
-
-        ctx.circle(cp, R, fill=(255,255,255))
-        images.append(image)
+
+        #the centre of the new dot needs to be at least 8 times the radius of the dot from the centre of the previous dot
+        cp = place_point(rng, width, height, R, avoid=[(cp, 8*R)])
+
+        specs.append(CardSpec(width, height, [('circle', cp, R)]))
 
     setseed(None)
 
-    return images
+    return specs
+
+
+def create_centraldot_images(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
+                             seed=None,nb_card=10):
+    '''
+    r_rel : float
+        Radius relative to the smallest image dimension, width or height
+    '''
+    specs = describe_centraldot_cards(
+            r_rel, width, height, seed=seed, nb_card=nb_card)
+    return [render_card(spec) for spec in specs]
+
+
+def describe_onepie_cards(N, width=CARD_WIDTH, height=CARD_HEIGHT,
+                          seed=None):
+    '''Describe the cards with one pie, one card per variation
+
+    Returns a list of CardSpec
+    '''
+    setseed(seed)
+
+    specs = []
+
+    for variation in _calc_variations(N):        
+        specs.append(CardSpec(width, height, [
+            ('pie', [0, 0, width, height], _randomize_rotation(variation))]))
+
+    setseed(None)
+
+    return specs
 
 
 def create_onepie_images(N, width=CARD_WIDTH, height=CARD_HEIGHT,
@@ -129,49 +319,34 @@ def create_onepie_images(N, width=CARD_WIDTH, height=CARD_HEIGHT,
     N : int
         The amount of slices in the pattern
     '''
-    setseed(seed)
+    specs = describe_onepie_cards(N, width, height, seed=seed)
+    return [render_card(spec) for spec in specs]
 
-    images = []
 
-    for variation in _calc_variations(N):        
-        image = Image.new('RGB', (width, height))
-        _draw_pie(image, 0, 0, width, height, variation)
-        images.append(image)
+def describe_stripe_cards(width=CARD_WIDTH, height=CARD_HEIGHT):
+    '''Describe the card with horizontal stripes
 
-    setseed(None)
+    Returns a list of one CardSpec
+    '''
+    lines = [('line', [0, i, width-1, i]) for i in range(0,height,10)]
+    return [CardSpec(width, height, lines)]
 
-    return images
 
 def create_stripe_image(width=CARD_WIDTH, height=CARD_HEIGHT, seed=None):
-    setseed(seed)
-    
-
-    image = Image.new('RGB', (width, height))
-    ctx = ImageDraw.Draw(image)
-
-    for i in range(0,height,10):
-         ctx.line((0,i), (width-1, i))
-
-    setseed(None)
-
-    return [image]
+    return [render_card(spec) for spec in describe_stripe_cards(width, height)]
 
 def setseed(state):
     random.seed(state)
 
 
 
-def create_multipie_images(N, M, right='1010', width=CARD_WIDTH, height=CARD_HEIGHT, seed=None, nb_card=12):
-    '''Create a image with one pie
+def describe_multipie_cards(N, M, right='1010', width=CARD_WIDTH,
+                            height=CARD_HEIGHT, seed=None, nb_card=12):
+    '''Describe the cards with M pies, one of them the right one
 
-    Attributes
-    ----------
-    N : int
-        The amount of slices in the pattern
-    M : int
-        The amount of patterns
+    Returns a list of CardSpec
     '''
-    images = []
+    specs = []
 
     setseed(seed)
 
@@ -189,7 +364,7 @@ def create_multipie_images(N, M, right='1010', width=CARD_WIDTH, height=CARD_HEI
         
         right_rot = random.randint(0,M-1)
 
-        image = Image.new('RGB', (width, height))
+        shapes = []
         
         for irot in range(M):
             cp = [
@@ -203,33 +378,51 @@ def create_multipie_images(N, M, right='1010', width=CARD_WIDTH, height=CARD_HEI
             else:
                 variation = random.choice(variations)
 
-            _draw_pie(
-                    image,
+            shapes.append(('pie', [
                     cp[0]-wpie/2, cp[1]-wpie/2,
-                    cp[0]+wpie/2, cp[1]+wpie/2,
-                    variation)
+                    cp[0]+wpie/2, cp[1]+wpie/2],
+                    _randomize_rotation(variation)))
 
-        images.append(image)
+        specs.append(CardSpec(width, height, shapes))
     
     setseed(None)
 
 
-    return images
+    return specs
 
 
-def create_dotVSsquare_images(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
-                             seed=None,nb_card=10):
+def create_multipie_images(N, M, right='1010', width=CARD_WIDTH, height=CARD_HEIGHT, seed=None, nb_card=12):
+    '''Create a image with one pie
+
+    Attributes
+    ----------
+    N : int
+        The amount of slices in the pattern
+    M : int
+        The amount of patterns
     '''
-    Used to make images with both a circle and a square. It also returns the coordinates of each (to be matched to the pixels of the camera for the movement detector)
+    specs = describe_multipie_cards(
+            N, M, right=right, width=width, height=height, seed=seed,
+            nb_card=nb_card)
+    return [render_card(spec) for spec in specs]
+
+
+def describe_dotVSsquare_cards(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
+                               seed=None, nb_card=10):
+    '''
+    Describe cards with both a circle and a square. It also returns the coordinates of each (to be matched to the pixels of the camera for the movement detector)
     r_rel : float
         Radius relative to the smallest image dimension, width or height
+
+    Returns (specs, circle_coord, square_coord)
     '''
 
-    images = []
+    specs = []
     circle_coord=[]
     square_coord=[]
 
     setseed(seed)
+    rng = _placement_rng()
 
     #create  fake dot centre at the corner of the drawing window to use for the first distance comparison of the first dot location
     cp_circle=[0,0]
@@ -237,9 +430,6 @@ def create_dotVSsquare_images(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
 
     
     for i in range(nb_card):
-        image = Image.new('RGB', (width, height))
-        ctx = ImageDraw.Draw(image)
-        
         #save the previous central point of the circle (we will change it in a moment but we still need it)
         cp_circle_previous=cp_circle
 
@@ -247,30 +437,12 @@ def create_dotVSsquare_images(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
         R = int(r_rel*min(width, height)/2) #circle radius length
         S = int(np.sqrt(np.pi)*R) #square side length
 
-        #compute a central point for the circle
-        cp_circle_temp = [int((width-R*2)*random.random()+R),
-              int((height-R*2)*random.random()+R)] 
-        
-        #as long as the centre of the centre of the new dot is less than 8 times the radius of the dot from the centre of the previous dot, 
-        # we recompute a new centre (np.linalg.norm between two points give teh euclidean distance)
-        while np.linalg.norm(np.array(cp_circle_temp) - np.array(cp_circle))<8*R: 
-            cp_circle_temp = [int((width-R*2)*random.random()+R),
-              int((height-R*2)*random.random()+R)]
-            
-        #once we have found a good new centre, we save it as cp
-        cp_circle=cp_circle_temp
-
-        #we now compute a centre point for the square
-        cp_square_temp = [int((width-S*2)*random.random()+S),
-              int((height-S*2)*random.random()+S)]
-
-        #as long as the centre of the square is not a certain distance away from the current circle, but also from the previous circle position and the previous square position, we pick up another point
-        while np.linalg.norm(np.array(cp_square_temp) - np.array(cp_circle))<5*R or np.linalg.norm(np.array(cp_square_temp) - np.array(cp_circle_previous))<8*R or np.linalg.norm(np.array(cp_square_temp) - np.array(cp_square))<8*R:
-            cp_square_temp = [int((width-S*2)*random.random()+S),
-              int((height-S*2)*random.random()+S)]
-            
-        #once we have found a good point, we save it
-        cp_square=cp_square_temp
+        #compute a central point for the circle, at least 8 times the radius of the dot from the centre of the previous dot
+        cp_circle = place_point(rng, width, height, R, avoid=[(cp_circle, 8*R)])
+
+        #we now compute a centre point for the square, a certain distance away from the current circle, but also from the previous circle position and the previous square position
+        cp_square = place_point(rng, width, height, S, avoid=[
+            (cp_circle, 5*R), (cp_circle_previous, 8*R), (cp_square, 8*R)])
 
         #we now compute the 2 opposite corners of the square from the centre
         square_corners=[cp_square[0]-S/2,cp_square[1]-S/2,cp_square[0]+S/2,cp_square[1]+S/2,]
@@ -279,25 +451,34 @@ def create_dotVSsquare_images(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
         circle_coord.append([cp_circle])
         square_coord.append([cp_square])
 
-        #draw the final shapes
-        ctx.circle(cp_circle, R, fill=(255,255,255))
-        ctx.rectangle(square_corners, fill=(255,255,255))
-        images.append(image)
+        #describe the final shapes
+        specs.append(CardSpec(width, height, [
+            ('circle', cp_circle, R),
+            ('rectangle', square_corners)]))
 
     setseed(None)
 
+    return specs, circle_coord, square_coord
+
+
+def create_dotVSsquare_images(r_rel, width=CARD_WIDTH, height=CARD_HEIGHT,
+                             seed=None,nb_card=10):
+    '''
+    Used to make images with both a circle and a square. It also returns the coordinates of each (to be matched to the pixels of the camera for the movement detector)
+    r_rel : float
+        Radius relative to the smallest image dimension, width or height
+    '''
+    specs, circle_coord, square_coord = describe_dotVSsquare_cards(
+            r_rel, width, height, seed=seed, nb_card=nb_card)
+    images = [render_card(spec) for spec in specs]
     return images, circle_coord, square_coord
 
 
-def create_calibcross_images(r_rel, xx, yy, width=CARD_WIDTH, height=CARD_HEIGHT):
+def describe_calibcross_card(r_rel, xx, yy, width=CARD_WIDTH, height=CARD_HEIGHT):
     '''
-    definition used to create crosses at specific coordinates for the user to click on during the camera/mask calibration.
+    Describe the card with a cross at specific coordinates for the user to click on during the camera/mask calibration.
     xx and yy are the coordinate of teh centre of the cross
     '''
-    #generate the image
-    image = Image.new('RGB', (width, height))
-    ctx = ImageDraw.Draw(image)
-
     #compute the length of the branches of the cross
     rel_length=int(r_rel*min(width, height)/2)
 
@@ -313,17 +494,426 @@ def create_calibcross_images(r_rel, xx, yy, width=CARD_WIDTH, height=CARD_HEIGHT
     vx1=xx
     vy1=yy+rel_length
 
-    #plot the lines to make the cross
-    ctx.line((hx0,hy0,hx1,hy1), fill=(255,255,255))
-    ctx.line((vx0,vy0,vx1,vy1), fill=(255,255,255))
+    #the lines making the cross
+    return CardSpec(width, height, [
+        ('line', [hx0,hy0,hx1,hy1]),
+        ('line', [vx0,vy0,vx1,vy1])])
 
-    return image
+
+def create_calibcross_images(r_rel, xx, yy, width=CARD_WIDTH, height=CARD_HEIGHT):
+    '''
+    definition used to create crosses at specific coordinates for the user to click on during the camera/mask calibration.
+    xx and yy are the coordinate of teh centre of the cross
+    '''
+    return render_card(describe_calibcross_card(r_rel, xx, yy, width, height))
+
+
+_render_executor = None
+
+def _get_render_executor():
+    global _render_executor
+    if _render_executor is None:
+        _render_executor = ThreadPoolExecutor(max_workers=1)
+    return _render_executor
+
+
+class CardDeck:
+    '''The cards of an experiment, shared by all the CardStimWidgets
+
+    The deck is described once, at the size of the largest view. Each
+    card is drawn once and the smaller views get it by downscaling, so
+    all the views show the same stimuli.
+
+    Attributes
+    ----------
+    cards : list of CardSpec
+        Card descriptions
+    right_stimu_coords, wrong_stimu_coords : list or None
+        For the experiments with several stimuli, one item per card
+        with the [[X1,Y1],[X2,Y2],...] coordinates (in the deck pixels)
+        of its right and wrong stimuli
+    key : str or None
+        DeckCache key of the deck, None if it cannot be reproduced
+    builder : dict or None
+        Name and arguments (seed included) of the function that built
+        the deck
+    '''
+    def __init__(self, cards, right_stimu_coords=None,
+                 wrong_stimu_coords=None, cache_size=4):
+        self.cards = cards
+        self.right_stimu_coords = right_stimu_coords
+        self.wrong_stimu_coords = wrong_stimu_coords
+        self.key = None
+        self.builder = None
+
+        # Card index -> Future of the drawn Pillow image
+        self.cache_size = cache_size
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cards)
+
+    def metadata(self, index):
+        '''Returns a dict with the index and the stimuli coordinates of the card
+        '''
+        meta = {'index': index}
+        if self.right_stimu_coords is not None:
+            meta['right_stimu_coords'] = self.right_stimu_coords[index]
+        if self.wrong_stimu_coords is not None:
+            meta['wrong_stimu_coords'] = self.wrong_stimu_coords[index]
+        return meta
+
+    def _future(self, index):
+        # The drawing of the card, started if needed
+        with self._lock:
+            future = self._images.pop(index, None)
+            if future is None:
+                future = _get_render_executor().submit(
+                        render_card, self.cards[index])
+            self._images[index] = future
+            while len(self._images) > self.cache_size:
+                self._images.popitem(last=False)
+        return future
+
+    def prefetch(self, index):
+        '''Start drawing the card in the background
+        '''
+        self._future(index)
+
+    def image(self, index, size=None):
+        '''Returns the Pillow image of the card
+
+        size : tuple or None
+            (width, height) to scale the card to
+        '''
+        image = self._future(index).result()
+        if size is not None and tuple(size) != image.size:
+            image = image.resize(size, Image.BOX)
+        return image
+
+
+def centraldot_deck(width=CARD_WIDTH, height=CARD_HEIGHT, seed=None,
+                    nb_card=10, r_rel=0.1):
+    '''Deck of cards with one dot
+    '''
+    return CardDeck(describe_centraldot_cards(
+            r_rel, width=width, height=height, seed=seed, nb_card=nb_card))
+
+
+def onepie_deck(width=CARD_WIDTH, height=CARD_HEIGHT, seed=None, nb_card=10,
+                N=4):
+    '''Deck of cards with one pie, one card per variation (nb_card unused)
+    '''
+    return CardDeck(describe_onepie_cards(
+            N, width=width, height=height, seed=seed))
+
+
+def multipie_deck(width=CARD_WIDTH, height=CARD_HEIGHT, seed=None,
+                  nb_card=10, N=4, M=4):
+    '''Deck of cards with M pies
+    '''
+    return CardDeck(describe_multipie_cards(
+            N, M, width=width, height=height, seed=seed, nb_card=nb_card))
+
+
+def dotVSsquare_deck(width=CARD_WIDTH, height=CARD_HEIGHT, seed=None,
+                     nb_card=10, r_rel=0.1, rewarded='dot'):
+    '''Deck of cards with a dot and a square
+
+    rewarded : "dot" or "square"
+        The right stimulus
+    '''
+    cards, circle_stimu_coords, square_stimu_coords = describe_dotVSsquare_cards(
+            r_rel, width=width, height=height, seed=seed, nb_card=nb_card)
+    if rewarded == 'dot':
+        return CardDeck(cards, right_stimu_coords=circle_stimu_coords,
+                        wrong_stimu_coords=square_stimu_coords)
+    return CardDeck(cards, right_stimu_coords=square_stimu_coords,
+                    wrong_stimu_coords=circle_stimu_coords)
+
+
+def _save_card(spec, path):
+    render_card(spec).save(path)
+    return path
+
+
+def render_card_files(cards, paths, workers=None, progress=None):
+    '''Draw the cards and save them as image files, in worker processes
+
+    Drawing a card only depends on its CardSpec (the random choices are
+    all made when the deck is described), so the files are the same
+    whatever the number of workers.
+
+    Arguments
+    ---------
+    cards : list of CardSpec
+    paths : list of str
+        Image file of each card
+    workers : int or None
+        Number of worker processes. 1 draws the cards in the calling
+        thread, None uses RENDER_WORKERS processes (less with fewer
+        CPUs).
+    progress : callable or None
+        Called as progress(n_done, n_total) after each saved card
+    '''
+    n_total = len(cards)
+    if workers is None:
+        workers = min(RENDER_WORKERS, max(1, (os.cpu_count() or 2) - 1))
+    workers = min(workers, n_total)
+
+    if workers <= 1:
+        for n_done, (spec, path) in enumerate(zip(cards, paths), 1):
+            _save_card(spec, path)
+            if progress is not None:
+                progress(n_done, n_total)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_save_card, spec, path)
+                   for spec, path in zip(cards, paths)]
+        for n_done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if progress is not None:
+                progress(n_done, n_total)
+
+
+class DeckCache:
+    '''Decks saved on disk, to reuse them and to keep a record of the stimuli
+
+    Each deck is saved in a folder named after its key, a hash of the
+    name and the arguments (seed included) of the deck builder. The
+    folder holds the card images (card_0000.png, ...) and deck.json
+    with the builder, the card descriptions and the stimuli coordinates.
+    deck.json is written last, so a deck without it is incomplete and
+    ignored.
+
+    Only decks with a seed are saved, others cannot be reproduced.
+
+    The cards are drawn and saved by render_card_files in worker
+    processes, from a background thread.
+
+    The least recently used decks are deleted when there are more than
+    max_decks of them or when they take more than max_bytes. The last
+    decks taken from this DeckCache (the ones that can be on screen)
+    are kept.
+
+    Attributes
+    ----------
+    folder : str
+        Folder of the saved decks
+    workers : int or None
+        Number of processes drawing the cards (see render_card_files)
+    max_decks : int
+        Maximum number of saved decks
+    max_bytes : int
+        Maximum disk space of the saved decks
+    '''
+    MANIFEST = 'deck.json'
+
+    def __init__(self, folder=None, workers=None, max_decks=50,
+                 max_bytes=1024**3):
+        if folder is None:
+            folder = os.path.join(os.path.expanduser('~'), '.arenaprog', 'decks')
+        self.folder = folder
+        self.workers = workers
+        self.max_decks = max_decks
+        self.max_bytes = max_bytes
+        self._writers = []
+        self._saving = {}
+        self._in_use = deque(maxlen=4)
+
+    @staticmethod
+    def key(builder, kwargs):
+        '''Returns the key of the deck built by builder(**kwargs)
+        '''
+        text = json.dumps({'builder': builder.__name__, 'args': kwargs},
+                          sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+    def path(self, key):
+        return os.path.join(self.folder, key)
+
+    def get(self, builder, **kwargs):
+        '''Returns the deck built by builder(**kwargs), loaded from the cache if saved
+
+        A deck that is not in the cache yet is built and saved in the
+        background.
+        '''
+        if kwargs.get('seed') is None:
+            return builder(**kwargs)
+
+        key = self.key(builder, kwargs)
+        self._in_use.append(key)
+        deck = self.load(key)
+        if deck is None:
+            deck = builder(**kwargs)
+            deck.key = key
+            deck.builder = {'name': builder.__name__, 'args': kwargs}
+            self.save(deck)
+        return deck
+
+    def load(self, key):
+        '''Returns the saved deck or None if it is not (completely) saved
+        '''
+        folder = self.path(key)
+        try:
+            with open(os.path.join(folder, self.MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # The manifest modification time orders the decks for the eviction
+        try:
+            os.utime(os.path.join(folder, self.MANIFEST))
+        except OSError:
+            pass
+
+        cards = [CardSpec.from_json(card, os.path.join(folder, card['file']))
+                 for card in manifest['cards']]
+        deck = CardDeck(cards, manifest['right_stimu_coords'],
+                        manifest['wrong_stimu_coords'])
+        deck.key = key
+        deck.builder = manifest['builder']
+        return deck
+
+    def save(self, deck):
+        '''Write the deck in a background thread
+        '''
+        self._saving[deck.key] = (0, len(deck.cards))
+        writer = threading.Thread(target=self._write, args=(deck,))
+        writer.start()
+        self._writers.append(writer)
+
+    def _write(self, deck):
+        folder = self.path(deck.key)
+        if os.path.exists(os.path.join(folder, self.MANIFEST)):
+            return
+        part = f'{folder}.part{os.getpid()}-{threading.get_ident()}'
+
+        try:
+            os.makedirs(part, exist_ok=True)
+            cards = []
+            for i_card, spec in enumerate(deck.cards):
+                card = spec.to_json()
+                card['file'] = f'card_{i_card:04d}.png'
+                cards.append(card)
+
+            def progress(n_done, n_total):
+                self._saving[deck.key] = (n_done, n_total)
+
+            render_card_files(
+                    deck.cards,
+                    [os.path.join(part, card['file']) for card in cards],
+                    workers=self.workers, progress=progress)
+
+            manifest = {
+                    'key': deck.key,
+                    'builder': deck.builder,
+                    'right_stimu_coords': deck.right_stimu_coords,
+                    'wrong_stimu_coords': deck.wrong_stimu_coords,
+                    'cards': cards,
+                    }
+            with open(os.path.join(part, self.MANIFEST), 'w') as f:
+                json.dump(manifest, f)
+
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(part, folder)
+            self.evict()
+        except OSError as e:
+            print(f'Could not save the deck {deck.key} in {folder}: {e}')
+            shutil.rmtree(part, ignore_errors=True)
+        finally:
+            self._saving.pop(deck.key, None)
+
+    def saved_decks(self):
+        '''Returns [(last use time, bytes, key)] of the saved decks, oldest first
+        '''
+        decks = []
+        try:
+            keys = os.listdir(self.folder)
+        except OSError:
+            return decks
+        for key in keys:
+            folder = self.path(key)
+            try:
+                last_use = os.path.getmtime(os.path.join(folder, self.MANIFEST))
+                size = sum(entry.stat().st_size for entry in os.scandir(folder))
+            except OSError:
+                continue
+            decks.append((last_use, size, key))
+        decks.sort()
+        return decks
+
+    def evict(self):
+        '''Delete the least recently used decks over max_decks or max_bytes
+        '''
+        decks = self.saved_decks()
+        n_decks = len(decks)
+        n_bytes = sum(size for last_use, size, key in decks)
+        for last_use, size, key in decks:
+            if n_decks <= self.max_decks and n_bytes <= self.max_bytes:
+                break
+            if key in self._in_use:
+                continue
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            n_decks -= 1
+            n_bytes -= size
+
+    def saving(self):
+        '''Returns {key: (n_done, n_total)} of the decks being saved
+        '''
+        return dict(self._saving)
+
+    def wait(self):
+        '''Wait until the decks have been written
+        '''
+        for writer in self._writers:
+            writer.join()
+        self._writers = []
+
+
+def image_ppm(image, width=None, height=None):
+    '''Returns binary PPM (or PGM for gray images) data of the image
+
+    image : Pillow image or ndarray
+        Pillow image or uint8 array of shape (height, width, 3) or
+        (height, width)
+    width, height : int or None
+        Crop the image to at most this size
+    '''
+    if hasattr(image, 'convert'):
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image = np.asarray(image)
+    else:
+        image = np.asarray(image, dtype=np.uint8)
+
+    image = image[:height, :width]
+    if image.ndim == 3:
+        image = image[:, :, :3]
+        magic = b'P6'
+    else:
+        magic = b'P5'
+    h, w = image.shape[:2]
+    header = magic + b' %d %d 255\n' % (w, h)
+    return header + np.ascontiguousarray(image).tobytes()
+
+
+def _image_rows(image):
+    '''Returns the pixels of the Pillow image as rows of RGB tuples
+    '''
+    pixels = list(image.convert('RGB').getdata())
+    w = image.width
+    return [pixels[i_row*w:(i_row+1)*w] for i_row in range(image.height)]
 
 
 class CardWidget(gb.FrameWidget):
     '''A stimulus
 
-    Load method is pretty slow, Hide and Show fast.
+    Load uploads the whole image to the Tk photo in one call as PPM
+    data. With a GUI backend that is not Tk it goes pixel row by pixel
+    row and is slow. Hide and Show are fast.
     '''
     def __init__(self, parent, width=CARD_WIDTH, height=CARD_HEIGHT):
         super().__init__(parent)
@@ -342,19 +932,40 @@ class CardWidget(gb.FrameWidget):
         image : Image
             Pillow image object
         '''
-        self.widget.image.set_from_rgb(image)
+        photo = self.widget.image
+        if isinstance(getattr(photo, 'tk', None), tk.PhotoImage):
+            data = image_ppm(image, photo.tk.width(), photo.tk.height())
+            photo.tk.tk.call(photo.tk, 'put', data, '-format', 'ppm')
+        else:
+            photo.set_from_rgb(_image_rows(image))
 
 
 class CardStimWidget(gb.FrameWidget):
     '''Generate different simulus cards
 
+    The CardDeck holds only CardSpec descriptions, so generating it is
+    instant, and it can be shared with other CardStimWidgets (set_deck).
+    A card is drawn and loaded into a CardWidget when it is shown,
+    while the following card is drawn in a background thread. The
+    CardWidgets of the last cache_size shown cards are kept and the
+    least recently shown one is reused for a new card, so the memory
+    does not grow with the number of cards.
+
     Attributes
     ----------
+    deck : CardDeck or None
+        The cards shown
+    current_card : CardWidget or None
+        The card on display
+    current_index : int or None
+        Index of the card on display in the deck
     next_card_callback : None or callable
         Function or method to be called every time the card is changed
+    deck_cache : DeckCache or None
+        Where the decks generated with a seed are saved and reused
     '''
     def __init__(self, parent, width=CARD_WIDTH, height=CARD_HEIGHT,
-                 make_nextbutton=True):
+                 make_nextbutton=True, cache_size=3, deck_cache=None):
         super().__init__(parent)
 
 
@@ -371,8 +982,15 @@ class CardStimWidget(gb.FrameWidget):
         self.width = width
         self.height = height
 
-        self.cards = []
+        self.deck = None
+        self.deck_cache = deck_cache
         self.current_card = None
+        self.current_index = None
+
+        # Card index -> CardWidget, least recently shown first
+        self.cache_size = max(cache_size, 2)
+        self._widgets = OrderedDict()
+        self._spare_widgets = []
         
         if make_nextbutton:
             self.b_next = gb.ButtonWidget(self, 'Next', command=self.next_card)
@@ -382,66 +1000,124 @@ class CardStimWidget(gb.FrameWidget):
 
         self.next_card_callback = None
 
+    def _next_index(self):
+        if self.current_index is None or self.current_index+1 >= len(self.cards):
+            return 0
+        return self.current_index + 1
+
+    def peek_next(self):
+        '''Returns the metadata of the card that next_card will show
+
+        None if there are no cards.
+        '''
+        if not self.cards:
+            return None
+        return self.deck.metadata(self._next_index())
+
+    @property
+    def current_metadata(self):
+        '''Metadata (see CardDeck.metadata) of the card on display, or None
+        '''
+        if self.current_index is None:
+            return None
+        return self.deck.metadata(self.current_index)
+
     def next_card(self, do_callback=True):
         if not self.cards:
             return
 
-        if self.current_card is None:
-            index = 0
-        else:
-            index = self.cards.index(self.current_card)
+        index = self._next_index()
+        if self.current_card is not None:
             try:
                 self.current_card.grid_remove()
             except Exception as e:
                 print(e)
-            index+=1
-
-        if index >= len(self.cards):
-            index = 0
        
-        self.current_card = self.cards[index]
+        self.current_card = self._card_widget(index)
+        self.current_index = index
         self.current_card.grid(row=1, column=0)
 
+        self.deck.prefetch(self._next_index())
+
         if do_callback and callable(self.next_card_callback):
             self.next_card_callback()
 
+    @property
+    def cards(self):
+        '''The CardSpecs of the deck
+        '''
+        if self.deck is None:
+            return []
+        return self.deck.cards
+
+    @property
+    def right_stimu_coords(self):
+        return self.deck.right_stimu_coords
+
+    @property
+    def wrong_stimu_coords(self):
+        return self.deck.wrong_stimu_coords
+
+    def _card_widget(self, index):
+        '''Returns the CardWidget showing the card, loading it if needed
+        '''
+        widget = self._widgets.pop(index, None)
+
+        if widget is None:
+            image = self.deck.image(index, (self.width, self.height))
+
+            if self._spare_widgets:
+                widget = self._spare_widgets.pop()
+            elif len(self._widgets) >= self.cache_size:
+                _, widget = self._widgets.popitem(last=False)
+            else:
+                widget = CardWidget(self, self.width, self.height)
+            widget.load(image)
+
+        self._widgets[index] = widget
+        return widget
+
     def create_card(self, image):
         '''Manually create and add a card from the given image
 
         image : Image object
             Pillow image
         '''
-        h = image.height
-        w = image.width
+        if self.deck is None:
+            self.set_deck(CardDeck([]))
+        self.deck.cards.append(
+                CardSpec(image.width, image.height, image=image))
 
-        converted = []
-        _converted = list(image.getdata())
-        for i_row in range(image.height):
-            row = _converted[i_row*w:(i_row+1)*w]
-            converted.append(row)
+    def set_deck(self, deck):
+        '''Show the cards of the deck from the first one on
 
-        card = CardWidget(self, self.width, self.height)
-        card.load(converted)
+        The deck can be shared with other CardStimWidgets, of any size.
+        '''
+        self._spare_widgets.extend(self._widgets.values())
+        self._widgets.clear()
 
-        self.cards.append(card)
+        self.deck = deck
+        self.current_card = None
+        self.current_index = None
 
     def clear_cards(self):
-        self.cards = []
+        self.set_deck(None)
 
     
+    def _build_deck(self, builder, **kwargs):
+        '''Build (or load from the deck cache) and show a deck of this widget size
+        '''
+        kwargs.update(width=self.width, height=self.height)
+        if self.deck_cache is not None:
+            deck = self.deck_cache.get(builder, **kwargs)
+        else:
+            deck = builder(**kwargs)
+        self.set_deck(deck)
+
     def create_centraldot_cards(self, seed=None,nb_card=10):
         '''Create cards that show one central dot
         '''
-        self.clear_cards()
-
-        images = create_centraldot_images(
-                r_rel=0.1, width=self.width, height=self.height,
-                seed=seed, nb_card=nb_card
-                )
-
-        for image in images:
-            self.create_card(image)
-        self.current_card = None
+        self._build_deck(centraldot_deck, seed=seed, nb_card=nb_card)
 
         self.stimucoord_list="list testing"
 
@@ -450,75 +1126,28 @@ class CardStimWidget(gb.FrameWidget):
         '''Change to onepie cards
             the nb_cards argument is not used as there are only 6 possibe cards, currently.
         '''
-        self.clear_cards()
-
-        images = create_onepie_images(
-                N, width=self.width, height=self.height,
-                seed=seed)
-        for image in images:
-            self.create_card(image)
-        self.current_card = None
+        self._build_deck(onepie_deck, N=N, seed=seed, nb_card=nb_card)
 
 
     def create_multipie_cards(self, N=4, M=4, seed=None, nb_card=10):
 
-        self.clear_cards()
-
-        images = create_multipie_images(
-                N, M, width=self.width, height=self.height,
-                seed=seed,nb_card=nb_card)
-        for image in images:
-            self.create_card(image)
-
-        self.current_card = None
+        self._build_deck(multipie_deck, N=N, M=M, seed=seed, nb_card=nb_card)
 
 
     def create_stripe_cards(self, seed=None, nb_card=10):
-        self.clear_cards()
-
-        images = create_stripe_images(self.width,self.height,seed)
-        for image in images:
-            self.create_card(image)
-
-        self.current_card = None
+        self.set_deck(CardDeck(describe_stripe_cards(self.width,self.height)))
     
 
     def create_dotVSsquare_dot_rewarded_cards(self, seed=None,nb_card=10):
-        '''Create cards that show one central dot
+        '''Create cards that show one dot and one square, the dot being the right stimulus
         '''
-        self.clear_cards()
-
-        images, circle_stimu_coords, square_stimu_coords = create_dotVSsquare_images(
-                r_rel=0.1, width=self.width, height=self.height,
-                seed=seed, nb_card=nb_card
-                )
-
-        for image in images:
-            self.create_card(image)
-        self.current_card = None
-
-        #put the coordinates in the right or wrong variable
-        self.right_stimu_coords=[circle_stimu_coords]
-        self.wrong_stimu_coords=[square_stimu_coords]
+        self._build_deck(dotVSsquare_deck, rewarded='dot', seed=seed, nb_card=nb_card)
 
 
     def create_dotVSsquare_square_rewarded_cards(self, seed=None,nb_card=10):
-        '''Create cards that show one central dot
+        '''Create cards that show one dot and one square, the square being the right stimulus
         '''
-        self.clear_cards()
-
-        images, circle_stimu_coords, square_stimu_coords = create_dotVSsquare_images(
-                r_rel=0.1, width=self.width, height=self.height,
-                seed=seed, nb_card=nb_card
-                )
-
-        for image in images:
-            self.create_card(image)
-        self.current_card = None
-
-        #put the coordinates in the right or wrong variable
-        self.right_stimu_coords=[square_stimu_coords]
-        self.wrong_stimu_coords=[circle_stimu_coords]
+        self._build_deck(dotVSsquare_deck, rewarded='square', seed=seed, nb_card=nb_card)
 
 
     #create the definition to generate the card of the calibration crosses
@@ -527,13 +1156,7 @@ class CardStimWidget(gb.FrameWidget):
         relat_size is to change the size relative to the size of the card (between 0 and 1)
         XX and YY are the coordinate of the centre of the cross'''
 
-        self.clear_cards()
-
-        calib_image = create_calibcross_images(r_rel=relat_size, xx=XX, yy=YY, width=self.width, height=self.height)
-        
-        self.create_card(calib_image)
-
-        self.current_card = None
+        self.set_deck(CardDeck([describe_calibcross_card(r_rel=relat_size, xx=XX, yy=YY, width=self.width, height=self.height)]))
 
 def main():
     
@@ -3,7 +3,10 @@
 
 import sys
 
-IMAGE_CACHE = []
+from .imagecache import ImageCache
+
+# Images built from files, reused until the file changes
+IMAGE_CACHE = ImageCache()
 
 def common_build_image(imclass, image, use_cache=True):
     '''Returns the ImageImage
@@ -12,8 +15,8 @@ def common_build_image(imclass, image, use_cache=True):
     '''
     if isinstance(image, str):
         image_fn = image
-        if use_cache and image_fn in IMAGE_CACHE:
-            image = IMAGE_CACHE[image_fn]
+        if use_cache:
+            image = IMAGE_CACHE.get(image_fn, imclass)
         else:
             image = imclass(image_fn)
     elif image is None:
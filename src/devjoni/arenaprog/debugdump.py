@@ -0,0 +1,148 @@
+'''Optional saving of the intermediate images for debugging.
+
+Off by default, so that normal runs do no debug disk I/O. When turned
+on, the images are written by a background thread and each image name
+is saved at most once per min_interval seconds. The debug messages
+are rate limited the same way.
+'''
+
+import os
+import time
+import threading
+import queue
+
+import cv2
+
+
+class DebugDump:
+    '''Saves debug images and prints debug messages when enabled
+
+    Can be passed to child processes as a Process argument. The writer
+    thread is started in the process that saves the first image.
+
+    Attributes
+    ----------
+    folder : str or None
+        Output folder. None disables all the debug output.
+    min_interval : float
+        Minimum time in seconds between two saves of the same image name,
+        or two prints of the same message
+    '''
+    def __init__(self, folder=None, min_interval=1.0, max_queue=8):
+        self.folder = folder
+        self.min_interval = min_interval
+        self.max_queue = max_queue
+        self._init_runtime()
+
+    def _init_runtime(self):
+        self._last_saves = {}
+        self._last_logs = {}
+        self._queue = None
+        self._thread = None
+
+    def __getstate__(self):
+        return {'folder': self.folder, 'min_interval': self.min_interval,
+                'max_queue': self.max_queue}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    @classmethod
+    def from_argv(cls, argv):
+        '''Enabled with "--debug-dump FOLDER" on the command line
+        '''
+        if '--debug-dump' not in argv:
+            return cls()
+        i = argv.index('--debug-dump')
+        if i+1 < len(argv) and not argv[i+1].startswith('--'):
+            folder = argv[i+1]
+        else:
+            folder = os.path.join(os.getcwd(), 'debug')
+        return cls(folder)
+
+    @property
+    def enabled(self):
+        return self.folder is not None
+
+    def _due(self, last_times, key, force):
+        now = time.perf_counter()
+        last = last_times.get(key)
+        if not force and last is not None and now-last < self.min_interval:
+            return None
+        return now
+
+    def log(self, message, *args, force=False):
+        '''Print only when debugging is enabled and the message is due
+
+        The same message (the first argument) is printed at most once
+        per min_interval seconds, so keep the changing values in the
+        other arguments.
+
+        Returns True if the message was printed.
+        '''
+        if not self.enabled:
+            return False
+        now = self._due(self._last_logs, message, force)
+        if now is None:
+            return False
+        print(message, *args)
+        self._last_logs[message] = now
+        return True
+
+    def save(self, name, image, force=False):
+        '''Save an image in the background if it is due
+
+        Arguments
+        ---------
+        name : str
+            File name inside the debug folder, for example "Mask.jpg"
+        image : ndarray or callable
+            The image, or a function returning it. The function is
+            called only if the image is actually saved.
+        force : bool
+            Ignore the rate limit
+
+        Returns True if the image was queued for saving.
+        '''
+        if not self.enabled:
+            return False
+
+        now = self._due(self._last_saves, name, force)
+        if now is None:
+            return False
+
+        if callable(image):
+            image = image()
+        else:
+            image = image.copy()
+
+        if self._thread is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        try:
+            self._queue.put_nowait((name, image))
+        except queue.Full:
+            return False
+        self._last_saves[name] = now
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            name, image = item
+            cv2.imwrite(os.path.join(self.folder, name), image)
+
+    def close(self):
+        '''Write the images still in the queue
+        '''
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._init_runtime()
@@ -0,0 +1,196 @@
+'''Shared-memory ring buffer for passing camera frames between processes.
+
+The pixels of each frame are copied once into a fixed slot of a
+shared memory block. Only the slot bookkeeping (write counter, read
+counter and the timestamps) goes through the multiprocessing
+primitives, so a 1280x800 frame is never pickled.
+
+When the reader falls behind, the oldest unread frame is dropped
+so that the reader always works on recent frames.
+'''
+
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from queue import Empty
+
+import numpy as np
+
+
+class FrameRing:
+    '''Fixed size ring buffer of frames in shared memory
+
+    The ring is created in the parent process and passed to the child
+    processes as a Process argument. The children attach to the same
+    shared memory block by its name.
+
+    Attributes
+    ----------
+    shape : tuple
+        Shape of one frame, for example (800, 1280, 3)
+    dtype : numpy.dtype
+        Data type of the frame pixels
+    n_slots : int
+        How many frames the ring can hold before dropping the oldest
+    '''
+    def __init__(self, shape=(800, 1280, 3), dtype=np.uint8, n_slots=8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n_slots = int(n_slots)
+
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._shm = shared_memory.SharedMemory(
+                create=True, size=frame_bytes*self.n_slots)
+        self._owner = True
+
+        self._cond = multiprocessing.Condition()
+
+        # Total frames written and total frames consumed (or dropped)
+        self._head = multiprocessing.Value('q', 0, lock=False)
+        self._tail = multiprocessing.Value('q', 0, lock=False)
+        self._dropped = multiprocessing.Value('q', 0, lock=False)
+
+        self._stamps = multiprocessing.Array('d', self.n_slots, lock=False)
+
+        self._attach()
+
+    def _attach(self):
+        self._slots = np.ndarray(
+                (self.n_slots,)+self.shape, dtype=self.dtype,
+                buffer=self._shm.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_slots']
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def put(self, frame, timestamp=None):
+        '''Copy a frame into the next free slot
+
+        If the ring is full, the oldest unread frame is dropped.
+
+        Arguments
+        ---------
+        frame : ndarray
+            Frame with the same shape and dtype as the ring
+        timestamp : float or None
+            Capture time of the frame. If None, time.perf_counter()
+            is used.
+
+        Returns the sequence number of the written frame.
+        '''
+        if timestamp is None:
+            timestamp = time.perf_counter()
+
+        with self._cond:
+            head = self._head.value
+            if head - self._tail.value >= self.n_slots:
+                self._tail.value += 1
+                self._dropped.value += 1
+
+            i_slot = head % self.n_slots
+            np.copyto(self._slots[i_slot], frame, casting='unsafe')
+            self._stamps[i_slot] = timestamp
+            self._head.value = head + 1
+
+            self._cond.notify_all()
+        return head
+
+    def get(self, block=True, timeout=None, out=None):
+        '''Take the oldest unread frame from the ring
+
+        Arguments
+        ---------
+        block : bool
+            If False, raise queue.Empty right away when there is no frame
+        timeout : float or None
+            Seconds to wait for a frame before raising queue.Empty.
+            None waits forever.
+        out : ndarray or None
+            Preallocated array to copy the frame into. If None, a new
+            array is allocated.
+
+        Returns (timestamp, frame)
+        '''
+        with self._cond:
+            if block:
+                available = self._cond.wait_for(
+                        lambda: self._head.value > self._tail.value,
+                        timeout)
+            else:
+                available = self._head.value > self._tail.value
+            if not available:
+                raise Empty
+
+            tail = self._tail.value
+            i_slot = tail % self.n_slots
+            if out is None:
+                out = self._slots[i_slot].copy()
+            else:
+                np.copyto(out, self._slots[i_slot])
+            timestamp = self._stamps[i_slot]
+            self._tail.value = tail + 1
+
+        return timestamp, out
+
+    def get_nowait(self, out=None):
+        '''Same as get(block=False)
+        '''
+        return self.get(block=False, out=out)
+
+    def frames(self, timeout=0.1, stop=None, out=None):
+        '''Iterate over the frames as they arrive
+
+        Sleeps in get between the frames instead of polling. The
+        iteration ends when stop() returns True, which is checked
+        before every frame and at least every timeout seconds while
+        no frames arrive.
+
+        Arguments
+        ---------
+        timeout : float
+            Seconds to wait for a frame before checking stop again
+        stop : callable or None
+            Returns True when the iteration has to end. If None, the
+            iteration never ends by itself.
+        out : ndarray or None
+            Array reused for every frame (see get). Each yielded frame
+            is then only valid until the next one is taken.
+
+        Yields (timestamp, frame)
+        '''
+        while stop is None or not stop():
+            try:
+                yield self.get(timeout=timeout, out=out)
+            except Empty:
+                continue
+
+    def empty(self):
+        '''Returns True if there are no unread frames
+        '''
+        return self._head.value <= self._tail.value
+
+    def clear(self):
+        '''Drop all unread frames
+        '''
+        with self._cond:
+            self._tail.value = self._head.value
+
+    @property
+    def dropped(self):
+        '''Number of frames dropped because the reader was too slow
+        '''
+        return self._dropped.value
+
+    def close(self):
+        '''Detach from the shared memory (and free it in the creator)
+        '''
+        self._slots = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
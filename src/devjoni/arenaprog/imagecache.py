@@ -0,0 +1,115 @@
+'''Bounded cache of the images loaded from files.
+
+The card images of the decks saved by DeckCache are decoded through
+IMAGE_CACHE, so a deck shown again (the same seed generated again, or
+the preview and the stimulus window) decodes its files only once.
+'''
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+    '''Least recently used cache of the images loaded from files
+
+    An image is loaded again if its file has changed (modification
+    time, size or inode) since it was cached. The least recently used
+    images are dropped when there are more than max_items images or
+    when they take more than max_bytes.
+
+    Can be used from several threads.
+
+    Attributes
+    ----------
+    max_items : int
+        Maximum number of cached images
+    max_bytes : int
+        Maximum memory of the cached images, as estimated by nbytes
+    hits, misses, evictions : int
+        Counters of the cache use
+    '''
+    def __init__(self, max_items=64, max_bytes=256*1024*1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stamp(fn):
+        try:
+            stat = os.stat(fn)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def get(self, fn, load, nbytes=None):
+        '''Returns the image of the file, loading it with load(fn) if needed
+
+        fn : str
+            Image file name
+        load : callable
+            Returns the image of a file. It is also part of the key,
+            so the same file can be cached in different forms.
+        nbytes : callable or None
+            Returns the memory used by an image. If None, the nbytes
+            attribute of the image is used (0 if missing).
+        '''
+        key = (fn, load)
+        stamp = self._stamp(fn)
+
+        with self._lock:
+            cached = self._images.get(key)
+            if cached is not None and stamp is not None and cached[0] == stamp:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+
+            self.misses += 1
+            if cached is not None:
+                self._remove(key)
+
+        # Loaded outside of the lock, two threads may load the same file
+        image = load(fn)
+        if stamp is None:
+            # Not a regular file, nothing to invalidate the cache with
+            return image
+
+        size = nbytes(image) if nbytes is not None else getattr(image, 'nbytes', 0)
+        with self._lock:
+            if key in self._images:
+                self._remove(key)
+            self._images[key] = (stamp, image, size)
+            self._bytes += size
+
+            while len(self._images) > 1 and (
+                    len(self._images) > self.max_items or
+                    self._bytes > self.max_bytes):
+                self._remove(next(iter(self._images)))
+                self.evictions += 1
+
+        return image
+
+    def _remove(self, key):
+        stamp, image, size = self._images.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''Returns the counters and the current size of the cache as a dict
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'items': len(self._images),
+                    'bytes': self._bytes}
+
+
+IMAGE_CACHE = ImageCache()
@@ -0,0 +1,248 @@
+'''Per-frame image processing of the movement detector.
+
+Only the regions of interest (ROIs) around the stimuli of the mask
+are processed, optionally downscaled, so the cost of a frame depends
+on the stimulus area and not on the camera resolution.
+'''
+
+import cv2
+import numpy as np
+
+
+def mask_rois(mask, margin=8):
+    '''Returns the bounding rectangles (x, y, w, h) of the mask regions
+
+    The rectangles are grown by margin pixels so that the morphology
+    at their borders gives the same result as on the full frame, and
+    overlapping rectangles are merged so that an object is never seen
+    twice.
+    '''
+    height, width = mask.shape[:2]
+    contours, _ = cv2.findContours(
+            mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    rects = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        x0 = max(x-margin, 0)
+        y0 = max(y-margin, 0)
+        x1 = min(x+w+margin, width)
+        y1 = min(y+h+margin, height)
+        rects.append([x0, y0, x1, y1])
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i+1, len(rects)):
+                a = rects[i]
+                b = rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                max(a[2], b[2]), max(a[3], b[3])]
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [(x0, y0, x1-x0, y1-y0) for x0, y0, x1, y1 in rects]
+
+
+def is_right_choice(point, stimu_coords):
+    '''Returns True if the point is at least as close to the right stimulus as to any other
+
+    Arguments
+    ---------
+    point : sequence
+        [X, Y] of the detected object
+    stimu_coords : ndarray
+        (N, 2) array with the right stimulus in the first row and the
+        wrong stimuli in the others (the right one may be repeated)
+    '''
+    dists = np.hypot(*(stimu_coords - point).T)
+    return dists[0] <= dists[1:].min()
+
+
+def _fit_to_scale(start, length, limit, k):
+    '''Returns start, length with length a multiple of k, inside [0, limit]
+
+    INTER_AREA resizes by an integer factor much faster than by an
+    arbitrary one.
+    '''
+    length = -(-length // k) * k
+    if length > limit:
+        length = limit // k * k
+    start = min(start, limit - length)
+    return start, length
+
+
+class _ROI:
+    '''One region of interest, its precomputed images and work buffers
+    '''
+    def __init__(self, rect, mask, stimulus_gray, downscale):
+        self.x, self.y, self.w, self.h = rect
+        self.downscale = downscale
+
+        if downscale > 1:
+            height, width = mask.shape[:2]
+            self.x, self.w = _fit_to_scale(self.x, self.w, width, downscale)
+            self.y, self.h = _fit_to_scale(self.y, self.h, height, downscale)
+
+        mask = mask[self.y:self.y+self.h, self.x:self.x+self.w]
+        stimulus_gray = stimulus_gray[self.y:self.y+self.h, self.x:self.x+self.w]
+
+        if downscale > 1:
+            self.size = (self.w//downscale, self.h//downscale)
+            mask = cv2.resize(mask, self.size, interpolation=cv2.INTER_NEAREST)
+            stimulus_gray = cv2.resize(
+                    stimulus_gray, self.size, interpolation=cv2.INTER_AREA)
+        else:
+            self.size = (self.w, self.h)
+
+        self.mask = mask
+        self.stimulus_masked = cv2.bitwise_and(
+                stimulus_gray, stimulus_gray, mask=mask)
+
+        # Output buffers reused on every frame. The masked buffer
+        # has to start from zeros as bitwise_and leaves the pixels
+        # outside of the mask untouched.
+        w, h = self.size
+        self.small = np.empty((h, w, 3), dtype=np.uint8)
+        self.gray = np.empty((h, w), dtype=np.uint8)
+        self.masked = np.zeros((h, w), dtype=np.uint8)
+        self.diff = np.empty((h, w), dtype=np.uint8)
+        self.opened = np.empty((h, w), dtype=np.uint8)
+        self.changed = np.empty((h, w), dtype=np.uint8)
+        self.processed = False
+
+    def crop(self, frame):
+        crop = frame[self.y:self.y+self.h, self.x:self.x+self.w]
+        if self.downscale > 1:
+            crop = cv2.resize(crop, self.size, dst=self.small,
+                              interpolation=cv2.INTER_AREA)
+        return crop
+
+
+class MovementDetector:
+    '''Finds the objects that appear over the stimuli
+
+    Compares each frame with the stimulus image, both covered with the
+    stimulus mask, inside the mask ROIs only.
+
+    Attributes
+    ----------
+    rois : list
+        The processed regions
+    areas : list
+        Areas (in full resolution pixels) of all the changed regions
+        found in the last frame, kept or not
+    '''
+    def __init__(self, mask, stimulus_image, sensitivity=50, mini_size=5,
+                 maxi_size=300, downscale=1):
+        '''
+        mask : ndarray
+            Mask from create_calib_mask (255 over the stimuli)
+        stimulus_image : ndarray
+            BGR image with the stimuli displayed and no fly
+        sensitivity : float
+            Gray level difference threshold
+        mini_size, maxi_size : float
+            Range of the area of an object, in full resolution pixels
+        downscale : int
+            Integer factor to shrink the ROIs by before processing. The
+            noise cleaning kernel shrinks with it (and is skipped when
+            it would be one pixel), the object sizes stay in full
+            resolution pixels.
+        '''
+        self.sensitivity = sensitivity
+        self.mini_size = mini_size
+        self.maxi_size = maxi_size
+        self.downscale = max(int(downscale), 1)
+
+        # 5x5 at full resolution, scaled to the downscaled ROIs
+        ksize = max(int(round(5/self.downscale)), 1)
+        if ksize % 2 == 0:
+            ksize += 1
+        if ksize > 1:
+            self.kernel = cv2.getStructuringElement(
+                    cv2.MORPH_ELLIPSE, (ksize,ksize))
+        else:
+            self.kernel = None
+
+        stimulus_gray = cv2.cvtColor(stimulus_image, cv2.COLOR_BGR2GRAY)
+        self.rois = [
+                _ROI(rect, mask, stimulus_gray, self.downscale)
+                for rect in mask_rois(mask)]
+
+        self.shape = mask.shape[:2]
+        self.areas = []
+
+    def process(self, frame):
+        '''Returns the objects detected in the BGR frame
+
+        Returns a list of (area, [cX, cY]) with the area in full
+        resolution pixels and the centre in full frame coordinates.
+        '''
+        k = self.downscale
+        area_scale = k*k
+
+        objects = []
+        self.areas = []
+
+        for roi in self.rois:
+            cv2.cvtColor(roi.crop(frame), cv2.COLOR_BGR2GRAY, dst=roi.gray)
+            cv2.bitwise_and(roi.gray, roi.gray, dst=roi.masked, mask=roi.mask)
+
+            # --- Absolute difference with the stimulus image with the mask ---
+            cv2.absdiff(roi.stimulus_masked, roi.masked, dst=roi.diff)
+
+            # --- Threshold to extract changed pixels ---
+            cv2.threshold(roi.diff, self.sensitivity, 255,
+                          cv2.THRESH_BINARY, dst=roi.changed)
+
+            # --- Clean noise ---
+            if self.kernel is not None:
+                cv2.morphologyEx(roi.changed, cv2.MORPH_OPEN, self.kernel,
+                                 dst=roi.opened)
+                cv2.morphologyEx(roi.opened, cv2.MORPH_CLOSE, self.kernel,
+                                 dst=roi.changed)
+            changed = roi.changed
+            roi.processed = True
+
+            # --- Keep only the regions of appropriate size ---
+            contours, _ = cv2.findContours(
+                    changed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                area = cv2.contourArea(contour) * area_scale
+                self.areas.append(area)
+                if not self.mini_size < area < self.maxi_size:
+                    continue
+
+                M = cv2.moments(contour)
+                if M["m00"] > 0:
+                    cx = M["m10"] / M["m00"]
+                    cy = M["m01"] / M["m00"]
+                else:
+                    x, y, w, h = cv2.boundingRect(contour)
+                    cx = x + w/2
+                    cy = y + h/2
+                objects.append(
+                        (area, [int(roi.x + cx*k), int(roi.y + cy*k)]))
+
+        return objects
+
+    def changed_image(self):
+        '''Returns the full frame size image of the changed pixels of the last frame
+        '''
+        image = np.zeros(self.shape, dtype=np.uint8)
+        for roi in self.rois:
+            if not roi.processed:
+                continue
+            changed = roi.changed
+            if self.downscale > 1:
+                changed = cv2.resize(
+                        changed, (roi.w, roi.h),
+                        interpolation=cv2.INTER_NEAREST)
+            image[roi.y:roi.y+roi.h, roi.x:roi.x+roi.w] = changed
+        return image
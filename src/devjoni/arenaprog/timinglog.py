@@ -0,0 +1,68 @@
+'''Timing sidecar of the recordings.
+
+Every written frame gets a row with its capture time, and the trial
+events (stimulus onset, reward, stop...) are saved in the same
+timeline. All times come from time.perf_counter(), which is shared by
+all processes of the computer, so the times of the GUI, recording and
+detector processes can be compared directly.
+'''
+
+import csv
+import threading
+
+
+def measure_fps(timestamps, default=20):
+    '''Returns the frame rate measured from the capture timestamps
+
+    The same frame read twice has the same timestamp and is counted
+    only once. If the rate cannot be measured (less than two frames),
+    the default is returned.
+    '''
+    unique = sorted(set(timestamps))
+    if len(unique) < 2 or unique[-1] <= unique[0]:
+        return default
+    return (len(unique)-1) / (unique[-1]-unique[0])
+
+
+class TimingLog:
+    '''Per-frame and event timeline of one recording, saved as CSV
+
+    Columns
+    -------
+    kind : "frame" or "event"
+    frame : index of the frame in the video (frames only)
+    t_mono : time.perf_counter() time in seconds
+    pos_msec : CAP_PROP_POS_MSEC of the camera when available (frames only)
+    label : name of the event (events only)
+    '''
+
+    HEADER = ('kind', 'frame', 't_mono', 'pos_msec', 'label')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._f = open(fn, 'w', newline='')
+        self._writer = csv.writer(self._f)
+        self._writer.writerow(self.HEADER)
+        self._lock = threading.Lock()
+
+    def frame(self, i_frame, t_mono, pos_msec=None):
+        '''Add a frame row
+        '''
+        if pos_msec is None:
+            pos_msec = ''
+        else:
+            pos_msec = f'{pos_msec:.3f}'
+        with self._lock:
+            self._writer.writerow(
+                    ('frame', i_frame, f'{t_mono:.6f}', pos_msec, ''))
+
+    def event(self, t_mono, label):
+        '''Add an event row
+        '''
+        with self._lock:
+            self._writer.writerow(
+                    ('event', '', f'{t_mono:.6f}', '', label))
+
+    def close(self):
+        with self._lock:
+            self._f.close()
@@ -0,0 +1,160 @@
+'''Signalling between the GUI, recording and movement detection processes.
+
+Replaces the message queues that were polled with get_nowait in busy
+loops. Waiting processes sleep on a shared Condition until a signal
+is posted or the timeout runs out.
+'''
+
+import time
+import multiprocessing
+
+
+class TrialSignals:
+    '''Named signals shared between processes
+
+    There are two kinds of signals. Messages (for example "reward")
+    are counted: every post wakes up one wait that consumes it.
+    Stop signals are latched: once posted they stay set for every
+    process checking them until they are cleared.
+
+    Every post is also stamped with time.perf_counter() into an event
+    log that the recorder saves into the timing sidecar of the video.
+    The log is kept in shared memory, so an event is visible to every
+    process as soon as post or mark returns. When more than
+    EVENT_SLOTS events are not drained, the oldest ones are dropped.
+
+    The object has to be passed to the child processes as a Process
+    argument.
+    '''
+
+    MESSAGES = (
+            'camera_ready',     # Recorder started, waiting for the stimulus
+            'stimulus_shown',   # Stimulus is on the screen, start recording
+            'reward',           # Detector asks for a reward
+            'trial_done',       # Recording of the trial has ended
+            )
+
+    STOPS = (
+            'stop_recording',   # Stops the recording and the preview
+            'stop_detection',   # Stops the movement detector
+            'stop_experiment',  # Stops the full experiment loop
+            )
+
+    NAMES = MESSAGES + STOPS
+
+    # Size of the event log and the longest label kept (in bytes)
+    EVENT_SLOTS = 256
+    LABEL_LENGTH = 64
+
+    def __init__(self):
+        self._cond = multiprocessing.Condition()
+        self._counts = multiprocessing.Array('i', len(self.NAMES), lock=False)
+
+        self._events_lock = multiprocessing.Lock()
+        self._event_times = multiprocessing.Array('d', self.EVENT_SLOTS, lock=False)
+        self._event_labels = multiprocessing.Array(
+                'c', self.EVENT_SLOTS*self.LABEL_LENGTH, lock=False)
+        # Total events logged and total events drained (or dropped)
+        self._event_head = multiprocessing.Value('q', 0, lock=False)
+        self._event_tail = multiprocessing.Value('q', 0, lock=False)
+
+    def _index(self, name):
+        try:
+            return self.NAMES.index(name)
+        except ValueError:
+            raise ValueError(f'Unknown signal: {name}')
+
+    def post(self, name):
+        '''Post a signal and wake up the processes waiting for it
+        '''
+        i = self._index(name)
+        t_post = time.perf_counter()
+        with self._cond:
+            # Logged before the signal can be seen, so a process woken
+            # by it always finds the event in the log
+            self._log_event(t_post, name)
+            self._counts[i] += 1
+            self._cond.notify_all()
+
+    def mark(self, label):
+        '''Add an event to the event log without posting a signal
+        '''
+        self._log_event(time.perf_counter(), label)
+
+    def _log_event(self, t_event, label):
+        data = label.encode('utf-8')[:self.LABEL_LENGTH]
+        with self._events_lock:
+            head = self._event_head.value
+            if head - self._event_tail.value >= self.EVENT_SLOTS:
+                self._event_tail.value += 1
+
+            i_slot = head % self.EVENT_SLOTS
+            start = i_slot * self.LABEL_LENGTH
+            self._event_times[i_slot] = t_event
+            self._event_labels[start:start+self.LABEL_LENGTH] = data.ljust(
+                    self.LABEL_LENGTH, b'\0')
+            self._event_head.value = head + 1
+
+    def drain_events(self):
+        '''Returns and removes the logged events as (time, label) tuples
+        '''
+        events = []
+        with self._events_lock:
+            head = self._event_head.value
+            for i_event in range(self._event_tail.value, head):
+                i_slot = i_event % self.EVENT_SLOTS
+                start = i_slot * self.LABEL_LENGTH
+                label = self._event_labels[start:start+self.LABEL_LENGTH]
+                events.append((self._event_times[i_slot],
+                               label.rstrip(b'\0').decode('utf-8', errors='replace')))
+            self._event_tail.value = head
+        return events
+
+    def is_set(self, name):
+        '''Returns True if the signal has been posted, without consuming it
+
+        Cheap enough to be checked on every frame.
+        '''
+        return self._counts[self._index(name)] > 0
+
+    def wait(self, *names, timeout=None):
+        '''Block until one of the given signals is posted
+
+        Arguments
+        ---------
+        names : str
+            Names of the signals to wait for
+        timeout : float or None
+            Seconds to wait. None waits forever.
+
+        Returns the name of the signal that was posted or None if the
+        timeout ran out. A returned message is consumed, a stop signal
+        stays set.
+        '''
+        indices = [self._index(name) for name in names]
+
+        def posted():
+            for i in indices:
+                if self._counts[i] > 0:
+                    return i
+            return None
+
+        with self._cond:
+            self._cond.wait_for(lambda: posted() is not None, timeout)
+            i = posted()
+            if i is None:
+                return None
+            name = self.NAMES[i]
+            if name in self.MESSAGES:
+                self._counts[i] -= 1
+        return name
+
+    def clear(self, *names):
+        '''Clear the given signals, or all of them if no names are given
+        '''
+        if not names:
+            names = self.NAMES
+        indices = [self._index(name) for name in names]
+        with self._cond:
+            for i in indices:
+                self._counts[i] = 0
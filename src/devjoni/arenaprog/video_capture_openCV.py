@@ -2,10 +2,22 @@
 import threading
 import time
 import cv2
+import numpy as np
 
 # Define video capture class
 class VideoCaptureAsync:
-    def __init__(self, src=0, width=640, height=480, driver=None):
+    '''Reads the camera in a background thread
+
+    Every new frame increments the seq counter, so that read_next can
+    wait for a frame that has not been returned yet.
+
+    With zero_copy=True the camera is read into n_buffers reused
+    arrays and read/read_next return them without copying. A returned
+    frame is then overwritten after n_buffers-1 further frames have
+    been captured, so copy it if it has to be kept longer.
+    '''
+    def __init__(self, src=0, width=640, height=480, driver=None,
+                 zero_copy=False, n_buffers=3):
         self.src = src
         if driver is None:
             self.cap = cv2.VideoCapture(self.src)
@@ -15,8 +27,15 @@ class VideoCaptureAsync:
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
         self.grabbed, self.frame = self.cap.read()
+        self.timestamp = time.perf_counter()
+        self.pos_msec = None
+        self.seq = 0
+        self._read_seq = 0
+        self.zero_copy = zero_copy
+        self._buffers = [None] * n_buffers
         self.started = False
         self.read_lock = threading.Lock()
+        self.new_frame = threading.Condition(self.read_lock)
         self.thread = None
 
     def get(self, var1):
@@ -35,21 +54,135 @@ class VideoCaptureAsync:
         return self
 
     def update(self):
+        i_buffer = 0
         while self.started:
-            grabbed, frame = self.cap.read()
-            with self.read_lock:
+            buffer = self._buffers[i_buffer]
+            if buffer is None:
+                grabbed, frame = self.cap.read()
+            else:
+                grabbed, frame = self.cap.read(buffer)
+            # Capture time of the frame, and the timestamp of the
+            # camera driver if it provides one
+            timestamp = time.perf_counter()
+            pos_msec = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+
+            if not grabbed:
+                with self.read_lock:
+                    self.grabbed = False
+                time.sleep(0.01)
+                continue
+
+            if self.zero_copy:
+                self._buffers[i_buffer] = frame
+                i_buffer = (i_buffer+1) % len(self._buffers)
+
+            with self.new_frame:
                 self.grabbed = grabbed
                 self.frame = frame
+                self.timestamp = timestamp
+                self.pos_msec = pos_msec if pos_msec > 0 else None
+                self.seq += 1
+                self.new_frame.notify_all()
+
+    def _current(self):
+        # Call with the read_lock held
+        if self.zero_copy or self.frame is None:
+            return self.frame
+        return self.frame.copy()
 
     def read(self):
         with self.read_lock:
-            frame = self.frame.copy()
+            frame = self._current()
             grabbed = self.grabbed
+            self._read_seq = self.seq
         return grabbed, frame
 
+    def read_next(self, timeout=None):
+        '''Wait for a frame that has not been returned yet
+
+        Arguments
+        ---------
+        timeout : float or None
+            Seconds to wait for the new frame. None waits until the
+            capture is stopped.
+
+        Returns (grabbed, frame, seq, timestamp, pos_msec). If there was
+        no new frame in time or the capture was stopped, grabbed is
+        False and frame None. A jump of seq by more than one means that
+        frames were captured but never read.
+        '''
+        with self.new_frame:
+            has_new = self.new_frame.wait_for(
+                    lambda: self.seq > self._read_seq or not self.started,
+                    timeout)
+            if not has_new or self.seq <= self._read_seq:
+                return False, None, self.seq, None, None
+            self._read_seq = self.seq
+            return (self.grabbed, self._current(), self.seq,
+                    self.timestamp, self.pos_msec)
+
+    def read_stamped(self):
+        '''Like read but returns also the capture time of the frame
+
+        Returns (grabbed, frame, timestamp, pos_msec) where timestamp is
+        time.perf_counter() right after the frame was read and pos_msec
+        the CAP_PROP_POS_MSEC of the camera, or None if not available.
+        '''
+        with self.read_lock:
+            frame = self._current()
+            grabbed = self.grabbed
+            timestamp = self.timestamp
+            pos_msec = self.pos_msec
+            self._read_seq = self.seq
+        return grabbed, frame, timestamp, pos_msec
+
     def stop(self):
         self.started = False
+        with self.new_frame:
+            self.new_frame.notify_all()
         self.thread.join()
 
     def __exit__(self, exec_type, exc_value, traceback):
-        self.cap.release()
\ No newline at end of file
+        self.cap.release()
+
+class FrameNormaliser:
+    '''Brings the camera frames to the recording size and orientation
+
+    Configured once per session and then called on every frame. The
+    resize is skipped when the camera already delivers the right size,
+    and the flip is done into preallocated buffers.
+
+    The returned frame is one of n_buffers reused arrays, so it is
+    overwritten after n_buffers further calls. Use enough buffers to
+    cover all the frames still in use elsewhere (for example waiting
+    in an encoder queue).
+
+    Attributes
+    ----------
+    size : tuple
+        Output (width, height)
+    flip_code : int
+        cv2.flip code. Positive mirrors around the vertical axis, like
+        the cv2.flip(frame, 180) used before.
+    '''
+    def __init__(self, width=1280, height=800, flip_code=1, n_buffers=1):
+        self.size = (width, height)
+        self.flip_code = flip_code
+        self._buffers = [None] * n_buffers
+        self._i_buffer = 0
+        self._resized = None
+
+    def __call__(self, frame):
+        h, w = frame.shape[:2]
+        if (w, h) != self.size:
+            self._resized = cv2.resize(frame, self.size, dst=self._resized)
+            frame = self._resized
+
+        dst = self._buffers[self._i_buffer]
+        if dst is None or dst.shape != frame.shape or dst.dtype != frame.dtype:
+            dst = np.empty_like(frame)
+            self._buffers[self._i_buffer] = dst
+        cv2.flip(frame, self.flip_code, dst=dst)
+
+        self._i_buffer = (self._i_buffer+1) % len(self._buffers)
+        return dst
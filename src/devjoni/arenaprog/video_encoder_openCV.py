@@ -0,0 +1,119 @@
+'''Video writing in a background thread.
+
+The capture loop only puts the frames in a bounded queue and the
+encoding happens in a worker thread. cv2.VideoWriter.write releases
+the GIL while encoding, so a thread is enough and the frames do not
+have to be copied to another process.
+'''
+import threading
+import queue
+
+import cv2
+
+from .timinglog import measure_fps
+
+# Number of frames held back at the start of a recording to measure the
+# camera frame rate before opening the video writer
+FPS_PROBE_FRAMES = 25
+
+
+class VideoEncoderAsync:
+    '''Writes frames to a video file in a worker thread
+
+    The writer is opened only once FPS_PROBE_FRAMES frames have been
+    received, at the frame rate measured from their capture times.
+
+    When the encoder falls behind, write waits at most put_timeout
+    seconds for room in the queue (back-pressure) and then drops the
+    frame.
+
+    Attributes
+    ----------
+    written : int
+        Frames written to the file
+    dropped : int
+        Frames dropped because the queue was full
+    high_water : int
+        Largest queue depth seen during the recording
+    fps : float or None
+        Frame rate of the video file, once the writer is open
+    '''
+    def __init__(self, save_path, fourcc, size, max_queue=32,
+                 put_timeout=0.005):
+        self.save_path = save_path
+        self.fourcc = fourcc
+        self.size = size
+        self.put_timeout = put_timeout
+        self.max_queue = max_queue
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.fps = None
+
+        self.out = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def write(self, frame, timestamp):
+        '''Queue a frame for writing
+
+        The frame must not be modified until it has left the queue
+        and been written (at most max_queue+1 further frames).
+
+        Returns True if the frame was queued, False if it was dropped.
+        '''
+        try:
+            self.queue.put((frame, timestamp), timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        depth = self.queue.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+        return True
+
+    def _open(self, probe_frames):
+        self.fps = measure_fps([t_frame for frame, t_frame in probe_frames])
+        self.out = cv2.VideoWriter(
+                self.save_path, self.fourcc, self.fps, self.size)
+        for frame, t_frame in probe_frames:
+            self._write(frame)
+
+    def _write(self, frame):
+        self.out.write(frame)
+        self.written += 1
+
+    def _run(self):
+        probe_frames = []
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            if self.out is None:
+                # Copied so that the caller can reuse its frame buffers
+                # as soon as the frames have left the queue
+                frame, t_frame = item
+                probe_frames.append((frame.copy(), t_frame))
+                if len(probe_frames) >= FPS_PROBE_FRAMES:
+                    self._open(probe_frames)
+                    probe_frames = []
+            else:
+                self._write(item[0])
+
+        # Recording shorter than the frame rate measurement
+        if self.out is None:
+            self._open(probe_frames)
+        self.out.release()
+
+    def stop(self):
+        '''Write the queued frames, close the file and wait for the thread
+        '''
+        self.queue.put(None)
+        self.thread.join()
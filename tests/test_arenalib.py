@@ -0,0 +1,274 @@
+import struct
+import threading
+import time
+
+import pytest
+
+from devjoni.arenaprog import arenalib
+from devjoni.arenaprog.arenalib import (
+        FRAME_START, OP_MOVE, OP_PING, Arena, FakeSerial, SerialLink,
+        handshake, make_frame)
+
+
+class BootingSerial(FakeSerial):
+    '''FakeSerial of a board that drops what it gets while it boots
+    '''
+    def __init__(self, boot_time):
+        super().__init__()
+        self.boot_end = time.perf_counter() + boot_time
+        self.port = None
+        self.baudrate = None
+        self.dtr = True
+        self.is_open = False
+
+    def open(self):
+        self.is_open = True
+
+    def write(self, message):
+        if time.perf_counter() < self.boot_end:
+            return len(message)
+        return super().write(message)
+
+
+class SilentSerial(BootingSerial):
+    def __init__(self):
+        super().__init__(boot_time=1e9)
+
+
+def test_handshake_waits_for_a_board_that_is_booting():
+    ser = BootingSerial(boot_time=1.2)
+
+    assert handshake(ser, timeout=3).startswith('arenafw')
+    # Nothing left over to be taken as the reply of the next command
+    assert ser.readline() == b''
+    assert ser.timeout == arenalib.READ_TIMEOUT
+
+
+def test_handshake_gives_up_after_the_timeout():
+    start = time.perf_counter()
+    assert handshake(SilentSerial(), timeout=0.5) is None
+    assert time.perf_counter() - start < 1.5
+
+
+class StreamingSerial(FakeSerial):
+    '''Another sketch on a board with the same USB id, printing nonstop
+    '''
+    def write(self, message):
+        return len(message)
+
+    def readline(self):
+        time.sleep(0.001)
+        return b'temperature 23.5\r\n'
+
+
+def test_handshake_gives_up_on_a_device_sending_nonstop():
+    start = time.perf_counter()
+    assert handshake(StreamingSerial(), timeout=0.5) is None
+    assert time.perf_counter() - start < 1
+
+    # Answers like an arena, then keeps sending
+    ser = StreamingSerial()
+    lines = iter([b'arenafw 2 frames\r\n'])
+    ser.readline = lambda: next(lines, b'temperature 23.5\r\n')
+    start = time.perf_counter()
+    assert handshake(ser, timeout=0.5) == 'arenafw 2 frames'
+    assert time.perf_counter() - start < 1
+
+
+class Port:
+    '''Stand-in of the ListPortInfo of an Arduino Uno
+    '''
+    vid = 0x2341
+    pid = 0x43
+    serial_number = None
+
+    def __init__(self, device):
+        self.device = device
+
+    def __lt__(self, other):
+        return self.device < other.device
+
+
+def _fake_ports(monkeypatch, tmp_path, boards):
+    monkeypatch.setattr(arenalib, 'LAST_PORT_FILE', str(tmp_path / 'last_port'))
+    ports = [Port(device) for device in boards]
+    monkeypatch.setattr(arenalib.list_ports, 'comports', lambda: ports)
+    monkeypatch.setattr(arenalib.serial, 'Serial', lambda: boards_iter.pop(0))
+    boards_iter = [boards[device]() for device in boards]
+
+
+def test_arena_is_found_after_a_reset_at_port_opening(monkeypatch, tmp_path):
+    _fake_ports(monkeypatch, tmp_path, {
+            'COM3': SilentSerial,
+            'COM4': lambda: BootingSerial(boot_time=1.0)})
+    monkeypatch.setattr(arenalib, 'HANDSHAKE_TIMEOUT', 2.0)
+
+    arena = Arena()
+    try:
+        assert arena.device == 'COM4'
+        assert arena.framed
+        assert arena.ser.dtr is False
+        assert arena.set_led(0, 1).result(2) == '#0 ok'
+    finally:
+        arena.close()
+    assert arenalib.detect_controller_devices()[0] == 'COM4'
+
+
+def test_missing_arena_is_reported(monkeypatch, tmp_path):
+    _fake_ports(monkeypatch, tmp_path, {'COM3': SilentSerial})
+    monkeypatch.setattr(arenalib, 'HANDSHAKE_TIMEOUT', 0.3)
+
+    with pytest.raises(RuntimeError):
+        Arena()
+
+
+class SlowSerial(FakeSerial):
+    '''FakeSerial replying delay seconds after each write
+    '''
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def write(self, message):
+        timer = threading.Timer(self.delay, FakeSerial.write, args=(self, message))
+        timer.daemon = True
+        timer.start()
+        return len(message)
+
+
+def test_replies_are_matched_to_the_commands_in_order():
+    link = SerialLink(FakeSerial())
+    try:
+        messages = ['A', 'bc', 'rrr', '', 'x']
+        futures = [link.send(message) for message in messages]
+        results = [future.result(2) for future in futures]
+    finally:
+        link.close()
+
+    assert results == [[f'fakeserial: {letter}' for letter in message]
+                       for message in messages]
+
+
+def test_missing_reply_expires_its_command_only():
+    link = SerialLink(SilentSerial(), timeout=0.2)
+    try:
+        start = time.perf_counter()
+        with pytest.raises(TimeoutError):
+            link.send('A').result(2)
+        assert time.perf_counter() - start < 1
+    finally:
+        link.close()
+
+
+def test_slow_reply_expires_and_does_not_go_to_the_next_command():
+    ser = SlowSerial(delay=0.5)
+    link = SerialLink(ser, timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError):
+            link.send('A').result(2)
+        # The late reply arrives while nothing is pending and is dropped
+        time.sleep(0.6)
+        ser.delay = 0
+        assert link.send('b').result(2) == ['fakeserial: b']
+    finally:
+        link.close()
+
+
+def test_close_fails_the_pending_commands():
+    link = SerialLink(SilentSerial(), timeout=60)
+    pending = link.send('AB')
+    time.sleep(0.2)
+    link.close()
+
+    with pytest.raises(ConnectionError):
+        pending.result(1)
+    with pytest.raises(ConnectionError):
+        link.send('A').result(1)
+
+
+def test_frame_layout_and_checksum():
+    frame = make_frame(OP_MOVE, 0x1FF, mask=0b101, value=-1000)
+
+    assert len(frame) == 9
+    assert frame[:4] == bytes([FRAME_START, OP_MOVE, 0xFF, 0b101])
+    # int32 little-endian, two's complement
+    assert frame[4:8] == bytes([0x18, 0xFC, 0xFF, 0xFF])
+    assert struct.unpack('<i', frame[4:8])[0] == -1000
+
+    check = 0
+    for byte in frame[:8]:
+        check ^= byte
+    assert frame[8] == check
+    assert make_frame(OP_PING, 3) == bytes(
+            [FRAME_START, OP_PING, 3, 0, 0, 0, 0, 0, FRAME_START ^ 3])
+
+
+def test_negative_move_reaches_the_fake_firmware():
+    arena = Arena(fake_serial=True)
+    try:
+        assert arena.framed
+        arena.move_platform(-3).result(2)
+        assert arena.refresh_status().result(2)['target'] == -1500
+    finally:
+        arena.close()
+
+
+class WrongSeqSerial(FakeSerial):
+    def _run_frame(self, frame):
+        return f'#{frame[2]+1} ok'
+
+
+def test_reply_with_wrong_sequence_number_is_rejected(monkeypatch):
+    monkeypatch.setattr(arenalib, 'FakeSerial', WrongSeqSerial)
+    arena = Arena(fake_serial=True)
+    try:
+        with pytest.raises(RuntimeError, match='did not acknowledge'):
+            arena.set_led(2, 1).result(2)
+    finally:
+        arena.close()
+
+
+class LaggingSerial(FakeSerial):
+    '''FakeSerial with the motor half a move short of its target
+    '''
+    def _run_frame(self, frame):
+        reply = super()._run_frame(frame)
+        if frame[1] == arenalib.OP_STATUS:
+            seq, ok, position, target, moving, leds = reply.split()
+            reply = f'{seq} ok {int(target)-250} {target} 1 {leds}'
+        return reply
+
+
+def test_status_is_parsed_in_the_units_of_arena_pos():
+    arena = Arena(fake_serial=True)
+    try:
+        arena.move_platform(3)
+        arena.set_led(1, 1)
+        status = arena.refresh_status().result(2)
+        assert status['position'] == status['target'] == 1500
+        assert status['pos'] == arena.pos == 3
+        assert not status['moving']
+        assert status['leds'] == {0: False, 1: True, 2: False, 3: False,
+                                  4: False, 5: False}
+
+        # The end-align moves 250 steps down and is the new zero
+        arena.step_end_align()
+        arena.move_platform(-2)
+        status = arena.refresh_status().result(2)
+        assert status['target'] == 1500 - 250 - 1000
+        assert status['pos'] == arena.pos == -2
+        assert arena.status() is status
+    finally:
+        arena.close()
+
+
+def test_status_of_a_moving_platform(monkeypatch):
+    monkeypatch.setattr(arenalib, 'FakeSerial', LaggingSerial)
+    arena = Arena(fake_serial=True)
+    try:
+        arena.move_platform(2)
+        status = arena.refresh_status().result(2)
+        assert status['moving']
+        assert status['pos'] == 1.5
+    finally:
+        arena.close()
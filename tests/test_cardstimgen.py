@@ -0,0 +1,112 @@
+import io
+import tkinter as tk
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import devjoni.guibase as gb
+from devjoni.arenaprog.cardstimgen import (
+        CardWidget, PlacementError, describe_centraldot_cards,
+        describe_multipie_cards, image_ppm, place_point, render_card)
+
+
+def _card(width=120, height=80):
+    spec = describe_multipie_cards(4, 4, width=width, height=height,
+                                   seed=1, nb_card=1)[0]
+    return render_card(spec)
+
+
+def test_impossible_placement_raises_instead_of_looping():
+    rng = np.random.default_rng(0)
+    # Every position of a 100x100 card is closer than 500 px to its centre
+    with pytest.raises(PlacementError):
+        place_point(rng, 100, 100, 10, avoid=[([50, 50], 500)])
+    with pytest.raises(PlacementError):
+        place_point(rng, 100, 100, 60)
+
+    # Dots too large to be 8 radii apart on the card
+    with pytest.raises(PlacementError):
+        describe_centraldot_cards(0.5, width=200, height=100, seed=3)
+
+
+def test_seeded_placement_is_deterministic():
+    avoid = [([100, 100], 60), ([300, 200], 80)]
+    points = [place_point(np.random.default_rng(42), 400, 300, 20, avoid)
+              for i in range(2)]
+    assert points[0] == points[1]
+
+    def deck(seed):
+        specs = describe_centraldot_cards(0.1, seed=seed, nb_card=20)
+        return [spec.to_json() for spec in specs]
+    assert deck(5) == deck(5)
+    assert deck(5) != deck(6)
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'L'])
+def test_image_ppm_decodes_to_the_same_pixels(mode):
+    image = _card().convert(mode)
+
+    decoded = Image.open(io.BytesIO(image_ppm(image)))
+
+    assert decoded.mode == mode
+    assert np.array_equal(np.asarray(decoded), np.asarray(image))
+
+
+def test_image_ppm_crops_to_the_photo_size():
+    image = _card(120, 80)
+
+    decoded = Image.open(io.BytesIO(image_ppm(image, 100, 50)))
+
+    assert decoded.size == (100, 50)
+    assert np.array_equal(np.asarray(decoded), np.asarray(image)[:50, :100])
+
+
+class _RecordingPhoto(tk.PhotoImage):
+    '''tk.PhotoImage that records the Tcl calls instead of needing a display
+    '''
+    def __init__(self, width, height):
+        self.name = 'photo'
+        self.calls = []
+        self._size = (width, height)
+        self.tk = SimpleNamespace(call=lambda *args: self.calls.append(args))
+
+    def width(self):
+        return self._size[0]
+
+    def height(self):
+        return self._size[1]
+
+    def __del__(self):
+        pass
+
+
+def test_card_load_uploads_ppm_to_the_guibase_photo():
+    image = _card(120, 80)
+    photo = gb.ImageImage.__new__(gb.ImageImage)
+    photo.tk = _RecordingPhoto(120, 80)
+    card = SimpleNamespace(widget=SimpleNamespace(image=photo))
+
+    CardWidget.load(card, image)
+
+    (target, command, data, option, fmt), = photo.tk.calls
+    assert (target, command, option, fmt) == (photo.tk, 'put', '-format', 'ppm')
+    assert np.array_equal(np.asarray(Image.open(io.BytesIO(data))),
+                          np.asarray(image))
+
+
+def test_card_load_shows_the_image_in_tk():
+    try:
+        window = gb.MainWindow()
+    except tk.TclError as e:
+        pytest.skip(f'No display for Tk: {e}')
+    try:
+        image = _card(120, 80)
+        card = CardWidget(window, 120, 80)
+        card.load(image)
+        photo = card.widget.image.tk
+        for x, y in [(0, 0), (60, 40), (119, 79)]:
+            assert tuple(photo.get(x, y)) == image.getpixel((x, y))
+    finally:
+        window.tk.destroy()
@@ -0,0 +1,26 @@
+from devjoni.arenaprog.debugdump import DebugDump
+
+
+def test_disabled_dump_prints_nothing(capsys):
+    debug = DebugDump()
+    assert not debug.log("Contour sizes:", [1, 2])
+    assert capsys.readouterr().out == ''
+
+
+def test_same_message_is_printed_once_per_interval(capsys):
+    debug = DebugDump('unused', min_interval=60)
+
+    printed = [debug.log("Contour sizes:", [i]) for i in range(100)]
+    assert printed == [True] + [False]*99
+    assert debug.log("number of object detected:", 1)
+    assert debug.log("Contour sizes:", [5], force=True)
+
+    assert capsys.readouterr().out.splitlines() == [
+            "Contour sizes: [0]", "number of object detected: 1",
+            "Contour sizes: [5]"]
+
+
+def test_message_is_printed_again_after_the_interval(capsys):
+    debug = DebugDump('unused', min_interval=0)
+    assert debug.log("Movement detected on stimulus")
+    assert debug.log("Movement detected on stimulus")
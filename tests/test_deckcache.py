@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+
+from devjoni.arenaprog.cardstimgen import (
+        DeckCache, dotVSsquare_deck, render_card_files)
+
+
+def _get(cache, seed):
+    deck = cache.get(dotVSsquare_deck, width=80, height=60, seed=seed, nb_card=3)
+    cache.wait()
+    return deck
+
+
+def test_same_seed_loads_the_saved_deck(tmp_path):
+    cache = DeckCache(str(tmp_path), workers=1)
+    built = _get(cache, 7)
+    loaded = _get(cache, 7)
+
+    assert loaded.key == built.key
+    assert all(spec.path is not None for spec in loaded.cards)
+    for i_card in range(len(built)):
+        assert np.array_equal(np.asarray(loaded.image(i_card)),
+                              np.asarray(built.image(i_card)))
+        assert loaded.metadata(i_card) == built.metadata(i_card)
+
+
+def test_least_recently_used_decks_are_evicted(tmp_path):
+    cache = DeckCache(str(tmp_path), workers=1, max_decks=5)
+    first = _get(cache, 1)
+    for seed in range(2, 12):
+        _get(cache, seed)
+        # The mtime of the manifest orders the decks
+        os.utime(os.path.join(cache.path(first.key), cache.MANIFEST))
+
+    keys = [key for last_use, size, key in cache.saved_decks()]
+    assert len(keys) == 5
+    assert first.key in keys
+
+
+def test_byte_limit_keeps_the_decks_in_use(tmp_path):
+    cache = DeckCache(str(tmp_path), workers=1, max_bytes=1)
+    decks = [_get(cache, seed) for seed in range(6)]
+
+    keys = [key for last_use, size, key in cache.saved_decks()]
+    assert sorted(keys) == sorted(deck.key for deck in decks[-4:])
+
+
+def test_parallel_files_are_identical_to_serial_files(tmp_path):
+    cards = dotVSsquare_deck(width=80, height=60, seed=4, nb_card=6).cards
+    files = {}
+    for workers in (1, 2):
+        paths = [str(tmp_path / f'{workers}_{i}.png') for i in range(len(cards))]
+        render_card_files(cards, paths, workers=workers)
+        files[workers] = [open(path, 'rb').read() for path in paths]
+
+    assert files[1] == files[2]
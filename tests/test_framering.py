@@ -0,0 +1,62 @@
+import multiprocessing
+from queue import Empty
+
+import numpy as np
+import pytest
+
+from devjoni.arenaprog.framering import FrameRing
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing(shape=(4, 6, 3), n_slots=3)
+    yield ring
+    ring.close()
+
+
+def _frame(value):
+    return np.full((4, 6, 3), value, dtype=np.uint8)
+
+
+def test_full_ring_drops_the_oldest_frames(ring):
+    for i in range(5):
+        ring.put(_frame(i), timestamp=float(i))
+
+    assert ring.dropped == 2
+    got = [ring.get_nowait() for i in range(3)]
+    assert [t for t, frame in got] == [2.0, 3.0, 4.0]
+    assert [frame[0, 0, 0] for t, frame in got] == [2, 3, 4]
+    assert ring.empty()
+
+
+def test_get_raises_empty_after_the_timeout(ring):
+    with pytest.raises(Empty):
+        ring.get(timeout=0.05)
+    with pytest.raises(Empty):
+        ring.get_nowait()
+
+
+def test_get_copies_into_out(ring):
+    out = np.zeros((4, 6, 3), dtype=np.uint8)
+    ring.put(_frame(7), timestamp=1.5)
+
+    t, frame = ring.get(out=out)
+    assert frame is out
+    assert t == 1.5 and out[3, 5, 2] == 7
+
+
+def _put_frames(ring, n):
+    for i in range(n):
+        ring.put(_frame(i), timestamp=float(i))
+
+
+def test_frames_put_in_child_process_are_read_in_parent(ring):
+    proc = multiprocessing.Process(target=_put_frames, args=(ring, 5))
+    proc.start()
+    proc.join(30)
+
+    assert proc.exitcode == 0
+    assert ring.dropped == 2
+    got = [ring.get(timeout=1) for i in range(3)]
+    assert [(t, frame[2, 3, 1]) for t, frame in got] == [
+            (2.0, 2), (3.0, 3), (4.0, 4)]
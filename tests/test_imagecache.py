@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+from devjoni.arenaprog import cardstimgen, common
+from devjoni.arenaprog.cardstimgen import DeckCache, centraldot_deck, render_card
+from devjoni.arenaprog.imagecache import ImageCache
+
+
+def _write(fn, text):
+    with open(fn, 'w') as f:
+        f.write(text)
+
+
+def _load(fn):
+    with open(fn) as f:
+        return np.frombuffer(f.read().encode(), dtype=np.uint8)
+
+
+def test_hits_invalidation_and_eviction(tmp_path):
+    cache = ImageCache(max_items=2)
+    fns = [str(tmp_path / f'{i}.txt') for i in range(3)]
+    for fn in fns:
+        _write(fn, 'a')
+
+    cache.get(fns[0], _load)
+    cache.get(fns[0], _load)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A changed file (here its size) is loaded again
+    _write(fns[0], 'bb')
+    assert bytes(cache.get(fns[0], _load)) == b'bb'
+    assert cache.misses == 2
+
+    cache.get(fns[1], _load)
+    cache.get(fns[2], _load)
+    stats = cache.stats()
+    assert stats['items'] == 2
+    assert stats['evictions'] == 1
+
+
+def test_byte_limit(tmp_path):
+    cache = ImageCache(max_bytes=5)
+    for i in range(3):
+        fn = str(tmp_path / f'{i}.txt')
+        _write(fn, 'abc')
+        cache.get(fn, _load)
+    assert cache.stats()['items'] == 1
+    assert cache.stats()['bytes'] == 3
+
+
+def test_saved_deck_cards_are_decoded_once(tmp_path):
+    decks = DeckCache(str(tmp_path), workers=1)
+    deck = decks.get(centraldot_deck, width=60, height=40, seed=3, nb_card=2)
+    decks.wait()
+    loaded = decks.load(deck.key)
+
+    cache = cardstimgen.IMAGE_CACHE
+    cache.clear()
+    hits, misses = cache.hits, cache.misses
+
+    first = [np.asarray(render_card(spec)) for spec in loaded.cards]
+    again = [np.asarray(render_card(spec)) for spec in decks.load(deck.key).cards]
+
+    assert (cache.hits - hits, cache.misses - misses) == (2, 2)
+    for a, b, spec in zip(first, again, deck.cards):
+        assert np.array_equal(a, b)
+        assert np.array_equal(a, np.asarray(render_card(spec)))
+
+
+def test_common_build_image_reuses_the_image_of_a_file(tmp_path):
+    fn = str(tmp_path / 'button.png')
+    _write(fn, 'png')
+    built = []
+
+    class Image:
+        def __init__(self, fn):
+            built.append(fn)
+
+    first = common.common_build_image(Image, fn)
+    assert common.common_build_image(Image, fn) is first
+    assert common.common_build_image(Image, fn, use_cache=False) is not first
+    assert built == [fn, fn]
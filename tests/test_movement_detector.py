@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from devjoni.arenaprog.bench_movement_detector import STIMULI, make_scene
+from devjoni.arenaprog.movement_detector import MovementDetector, is_right_choice
+
+
+@pytest.mark.parametrize('downscale', [1, 2, 4])
+def test_fly_is_detected_at_every_downscale(downscale):
+    mask, stimulus, frame = make_scene()
+    detector = MovementDetector(mask, stimulus, downscale=downscale)
+
+    objects = detector.process(frame)
+
+    assert len(objects) == 1
+    area, (cx, cy) = objects[0]
+    fly = [STIMULI[0][0]+30, STIMULI[0][1]]
+    assert abs(cx - fly[0]) <= downscale + 2
+    assert abs(cy - fly[1]) <= downscale + 2
+    assert is_right_choice([cx, cy], np.asarray([STIMULI[0]] + STIMULI, dtype=float))
+
+
+@pytest.mark.parametrize('downscale', [1, 2, 4])
+def test_nothing_is_detected_without_fly(downscale):
+    mask, stimulus, frame = make_scene()
+    detector = MovementDetector(mask, stimulus, downscale=downscale)
+
+    assert detector.process(stimulus) == []
+    assert detector.changed_image().shape == mask.shape
@@ -0,0 +1,34 @@
+import multiprocessing
+
+from devjoni.arenaprog.trialsignals import TrialSignals
+
+
+def _post_and_mark(signals):
+    signals.mark('card:abc:3')
+    signals.post('reward')
+    signals.post('stop_detection')
+
+
+def test_events_from_other_process_are_drained_right_after_posting():
+    signals = TrialSignals()
+    proc = multiprocessing.Process(target=_post_and_mark, args=(signals,))
+    proc.start()
+
+    # stop_detection is the last event, once it is set the others are logged too
+    assert signals.wait('stop_detection', timeout=30) == 'stop_detection'
+    labels = [label for t_event, label in signals.drain_events()]
+    proc.join()
+
+    assert labels == ['card:abc:3', 'reward', 'stop_detection']
+    assert signals.drain_events() == []
+
+
+def test_event_log_drops_the_oldest_events_when_full():
+    signals = TrialSignals()
+    for i in range(signals.EVENT_SLOTS + 10):
+        signals.mark(f'event {i}')
+
+    events = signals.drain_events()
+    assert len(events) == signals.EVENT_SLOTS
+    assert events[0][1] == 'event 10'
+    assert [t for t, label in events] == sorted(t for t, label in events)
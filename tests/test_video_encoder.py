@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+import pytest
+
+from devjoni.arenaprog import video_encoder_openCV
+from devjoni.arenaprog.video_encoder_openCV import (
+        FPS_PROBE_FRAMES, VideoEncoderAsync)
+
+
+class StubWriter:
+    '''Stand-in of cv2.VideoWriter that keeps the frame values
+    '''
+    opened = []
+
+    def __init__(self, path, fourcc, fps, size):
+        self.fps = fps
+        self.frames = []
+        self.released = False
+        self.gate = None
+        StubWriter.opened.append(self)
+
+    def write(self, frame):
+        if self.gate is not None:
+            self.gate.wait()
+        self.frames.append(int(frame[0, 0]))
+
+    def release(self):
+        self.released = True
+
+
+@pytest.fixture
+def writers(monkeypatch):
+    StubWriter.opened = []
+    monkeypatch.setattr(video_encoder_openCV.cv2, 'VideoWriter', StubWriter)
+    return StubWriter.opened
+
+
+def _frame(value):
+    return np.full((2, 2), value, dtype=np.uint8)
+
+
+def test_writer_opens_at_the_fps_of_the_probe_frames(writers):
+    encoder = VideoEncoderAsync('out.avi', 0, (2, 2)).start()
+    n_frames = FPS_PROBE_FRAMES + 10
+    for i in range(n_frames):
+        # Same frame read twice is counted once
+        encoder.write(_frame(i % 256), 1.0 + (i // 2) / 50)
+    encoder.stop()
+
+    writer, = writers
+    assert writer.fps == pytest.approx(50)
+    assert writer.frames == list(range(n_frames))
+    assert writer.released
+    assert encoder.written == n_frames and encoder.dropped == 0
+
+
+def test_stop_flushes_a_recording_shorter_than_the_probe(writers):
+    encoder = VideoEncoderAsync('out.avi', 0, (2, 2)).start()
+    for i in range(3):
+        encoder.write(_frame(i), i / 10)
+    encoder.stop()
+
+    writer, = writers
+    assert writer.fps == pytest.approx(10)
+    assert writer.frames == [0, 1, 2] and writer.released
+
+
+def test_frames_are_dropped_when_the_encoder_falls_behind(writers):
+    encoder = VideoEncoderAsync('out.avi', 0, (2, 2), max_queue=4,
+                                put_timeout=0.001).start()
+    for i in range(FPS_PROBE_FRAMES):
+        encoder.write(_frame(i), i / 100)
+
+    # Wait for the writer to open, then block it
+    while not writers:
+        pass
+    gate = threading.Event()
+    writers[0].gate = gate
+
+    results = [encoder.write(_frame(100+i), 1 + i / 100) for i in range(20)]
+    gate.set()
+    encoder.stop()
+
+    # The writer may still have taken the first frame of the batch
+    assert sum(results) in (4, 5, 6)
+    assert encoder.dropped == 20 - sum(results)
+    assert encoder.high_water == 4
+    assert encoder.written == FPS_PROBE_FRAMES + sum(results)
+    assert writers[0].frames[FPS_PROBE_FRAMES:] == list(
+            range(100, 100 + sum(results)))